@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+""" Compare metadata fetchers on a generated schema with many tables.
+
+    python benchmarks/metadata_fetchers.py \
+        postgresql://ryan@localhost:5432/yamlsql-test --tables 10000
+"""
+import time
+
+import click
+from sqlalchemy import create_engine
+
+from yamlsql.dbmeta import METADATA_FETCHERS
+
+SCHEMA = 'yamlsql_bench'
+BATCH_SIZE = 500
+
+
+def create_schema(conn, tables, columns):
+    conn.execute('drop schema if exists {} cascade'.format(SCHEMA))
+    conn.execute('create schema {}'.format(SCHEMA))
+    fields = ', '.join('c{} integer'.format(i) for i in xrange(columns))
+    # Commit in batches, a single transaction would run out of locks
+    for start in xrange(0, tables, BATCH_SIZE):
+        end = min(start + BATCH_SIZE, tables)
+        conn.execute(';'.join(
+            'create table {}.t{} ({})'.format(SCHEMA, i, fields)
+            for i in xrange(start, end)))
+
+
+def timeit(func, repeat):
+    timings = []
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings), sum(timings) / len(timings)
+
+
+@click.command()
+@click.argument('conn_string')
+@click.option('--tables', default=10000)
+@click.option('--columns', default=10)
+@click.option('--repeat', default=5)
+@click.option('--keep/--no-keep', default=False,
+              help='Keep the generated schema')
+def main(conn_string, tables, columns, repeat, keep):
+    conn = create_engine(conn_string)
+    print 'Creating {} tables with {} columns...'.format(tables, columns)
+    create_schema(conn, tables, columns)
+    try:
+        for name, cls in sorted(METADATA_FETCHERS.items()):
+            fetcher = cls(conn)
+            meta = fetcher.fetch(schemas=[SCHEMA])
+            assert len(meta) == tables
+            best, avg = timeit(lambda: fetcher.fetch(schemas=[SCHEMA]), repeat)
+            print '{:<20} fetch   min {:.3f}s avg {:.3f}s'.format(
+                name, best, avg)
+            best, avg = timeit(lambda: fetcher.fetch_markers([SCHEMA]), repeat)
+            print '{:<20} markers min {:.3f}s avg {:.3f}s'.format(
+                name, best, avg)
+    finally:
+        if not keep:
+            conn.execute('drop schema {} cascade'.format(SCHEMA))
+
+
+if __name__ == '__main__':
+    main()
@@ -183,7 +183,8 @@
      (yamlsql--http-get "/describe_field"
                         `(("conn_id" . ,yamlsql-conn-id)
                           ("table" . ,table)
-                          ("field" . ,field))
+                          ("field" . ,field)
+                          ("mode" . "catalog"))
                         'yamlsql--print-text))
    )
   )
@@ -216,3 +217,41 @@
                           (yamlsql--output (assoc-default 'text data)))
                         ))
   )
+
+(defvar yamlsql-job-poll-interval 1
+  "Seconds between two polls of an asynchronous query job.")
+
+(defun yamlsql-run-sql-async ()
+  (interactive)
+  (let ((content (buffer-string))
+        (lineno (line-number-at-pos)))
+    (yamlsql--http-post "/run_sql?async=1"
+                        `(("conn_id" . ,yamlsql-conn-id)
+                          ("content" . ,content)
+                          ("lineno" . ,lineno))
+                        (lambda (status data)
+                          (let ((job-id (assoc-default 'job_id data)))
+                            (message "Query job %s submitted." job-id)
+                            (yamlsql--poll-job job-id))))))
+
+(defun yamlsql--poll-job (job-id)
+  (run-with-timer
+   yamlsql-job-poll-interval nil
+   (lambda ()
+     (yamlsql--http-get "/job_status"
+                        `(("job_id" . ,job-id))
+                        (lambda (status data)
+                          (if (member (assoc-default 'status data)
+                                      '("pending" "running"))
+                              (yamlsql--poll-job job-id)
+                            (yamlsql--http-get "/job_result"
+                                               `(("job_id" . ,job-id))
+                                               'yamlsql--print-text)))))))
+
+(defun yamlsql-cancel-job (job-id)
+  (interactive (list (read-from-minibuffer "Job ID:")))
+  (yamlsql--http-post "/cancel_job"
+                      `(("job_id" . ,job-id))
+                      (lambda (status data)
+                        (message "Job %s cancelled: %S"
+                                 job-id (assoc-default 'cancelled data)))))
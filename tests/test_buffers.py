@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+
+from yamlsql import buffers, errors
+
+CONTENT = """- name: query1
+  sql: select * from public.test_data
+
+- name: query2
+  sql: select gender from public.test_data
+"""
+
+
+def test_apply_edits():
+    buf = buffers.Buffer(CONTENT)
+    assert buf.apply([{'start': 2, 'end': 3,
+                       'text': '  sql: select age from public.test_data'}]) == 1
+    assert buf.content.splitlines()[1] == '  sql: select age from public.test_data'
+    buf.apply([{'start': 6, 'end': 6, 'text': '  limit: 10\n'}])
+    assert buf.content.endswith('  limit: 10\n')
+    buf.apply([{'start': 3, 'end': 7}])
+    assert buf.content == CONTENT.splitlines(True)[0] + \
+        '  sql: select age from public.test_data\n'
+
+
+def test_apply_edits_version():
+    buf = buffers.Buffer(CONTENT)
+    buf.apply([], version=0)
+    with pytest.raises(errors.BufferOutOfDate):
+        buf.apply([], version=0)
+    with pytest.raises(ValueError):
+        buf.apply([{'start': 3, 'end': 20, 'text': ''}])
+
+
+def test_buffer_registry():
+    buf = buffers.open_buffer(CONTENT)
+    assert buffers.get_buffer(buf.buffer_id) is buf
+    buffers.update_buffer(buf.buffer_id, [{'start': 1, 'end': 1, 'text': '\n'}])
+    assert buf.version == 1
+    assert buffers.close_buffer(buf.buffer_id)
+    with pytest.raises(errors.BufferNotFound):
+        buffers.get_buffer(buf.buffer_id)
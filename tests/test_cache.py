@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+
+from yamlsql.cache import LRUCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['hits'] == 3
+    assert cache.stats()['misses'] == 1
+
+
+def test_max_size():
+    cache = LRUCache(max_size=10)
+    cache.set('a', 1, size=4)
+    cache.set('b', 2, size=4)
+    cache.set('c', 3, size=4)
+    assert cache.get('a') is None
+    assert cache.size == 8
+    cache.set('d', 4, size=20)
+    assert cache.get('d') is None
+    assert cache.get('b') == 2
+
+
+def test_ttl():
+    cache = LRUCache(ttl=0.05)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    time.sleep(0.1)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_invalidate():
+    cache = LRUCache()
+    for key in [('t1', 'a'), ('t1', 'b'), ('t2', 'a')]:
+        cache.set(key, 1)
+    assert cache.invalidate(lambda key: key[0] == 't1') == 2
+    assert cache.get(('t2', 'a')) == 1
+    assert cache.invalidate() == 1
+    assert len(cache) == 0
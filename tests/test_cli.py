@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+
+from click.testing import CliRunner
+
+from yamlsql.cli import cli
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def test_render(tmpdir):
+    runner = CliRunner()
+    out_dir = str(tmpdir.join('out'))
+    result = runner.invoke(cli, ['render', DATA_DIR, '--out-dir', out_dir,
+                                 '--format-mode', 'none'])
+    assert result.exit_code == 0
+    assert '2 rendered, 0 unchanged' in result.output
+    assert os.path.exists(os.path.join(out_dir, 'simple.sql'))
+
+    result = runner.invoke(cli, ['render', DATA_DIR, '--out-dir', out_dir,
+                                 '--format-mode', 'none'])
+    assert '0 rendered, 2 unchanged' in result.output
+
+    broken = tmpdir.join('broken.yaml')
+    broken.write('- name: a\n  with: b\n  sql: select 1\n')
+    result = runner.invoke(cli, ['render', str(broken)])
+    assert result.exit_code == 1
+    assert 'broken.yaml' in result.output
+
+
+def test_render_duplicate_names(tmpdir):
+    for name in ('a', 'b'):
+        tmpdir.mkdir(name).join('query.yaml').write('- sql: select 1\n')
+    runner = CliRunner()
+    result = runner.invoke(cli, ['render', str(tmpdir.join('a', 'query.yaml')),
+                                 str(tmpdir.join('b', 'query.yaml')),
+                                 '--out-dir', str(tmpdir.join('out'))])
+    assert result.exit_code == 2
+    assert 'both render to' in result.output
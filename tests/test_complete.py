@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+
+from yamlsql.complete import CompletionIndex
+
+
+def _fields(*names):
+    return {'fields': [{'field': n, 'type': 'text'} for n in names]}
+
+
+@pytest.fixture
+def index():
+    index = CompletionIndex(['public'])
+    index.update({
+        'public.user': _fields('id', 'name', 'email'),
+        'public.user_event': _fields('user_id', 'event'),
+        'archive.user': _fields('id'),
+        'archive.users_2017': _fields('id'),
+        })
+    return index
+
+
+def test_complete_tables(index):
+    names = [t['table'] for t in index.tables('user')]
+    assert names == [
+        'public.user', 'archive.user', 'public.user_event',
+        'archive.users_2017']
+    assert [t['table'] for t in index.tables('archive.us')] == [
+        'archive.user', 'archive.users_2017']
+    assert index.tables('order') == []
+
+
+def test_complete_columns(index):
+    columns = index.columns('public.user', 'E')
+    assert columns == [{'name': 'email', 'type': 'text',
+                        'table': 'public.user'}]
+
+
+def test_update_schema(index):
+    meta = dict(index._meta)
+    del meta['archive.users_2017']
+    meta['archive.user'] = _fields('id', 'created')
+    index.update(meta, schemas=['archive'])
+    assert [t['table'] for t in index.tables('archive.')] == ['archive.user']
+    assert [c['name'] for c in index.columns('archive.user', 'c')] == [
+        'created']
+    assert [t['table'] for t in index.tables('user_')] == ['public.user_event']
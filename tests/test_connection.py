@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+
+from yamlsql import connection
+from yamlsql.connection import create_conn, get_db, using
+from yamlsql.errors import ConnectionLimitReached
+
+CONN_STRING = "postgresql://ryan@localhost:5432/yamlsql-test"
+
+
+def test_connection_budget(monkeypatch):
+    monkeypatch.setattr(connection, 'CONN_MAP', {})
+    monkeypatch.setattr(connection, 'MAX_CONNECTIONS', 30)
+    first = create_conn(CONN_STRING + '?application_name=first')
+    second = create_conn(CONN_STRING + '?application_name=second')
+    with using(second.conn_id):
+        # the idle connection makes room for a new one
+        third = create_conn(CONN_STRING + '?application_name=third')
+        assert get_db(first.conn_id) is None
+        with using(third.conn_id):
+            with pytest.raises(ConnectionLimitReached):
+                create_conn(CONN_STRING + '?application_name=fourth')
+    assert connection.connections()['capacity'] == 30
+    evicted = connection.evict_idle(timeout=0)
+    assert sorted(evicted) == sorted([second.conn_id, third.conn_id])
+    assert not connection.CONN_MAP
@@ -3,8 +3,13 @@
 
 from pprint import pprint
 
+import pytest
 from pytest import approx
 
+from yamlsql.dbmeta import (DBMeta, METADATA_FETCHERS, limit_sql,
+                             normalize_sql, is_read_only)
+from yamlsql.errors import QueryTooExpensive
+
 def test_list_tables(db):
     result = db.list_tables()
     assert result == [
@@ -12,6 +17,49 @@ def test_list_tables(db):
         'public.test_user',
         'public.test_user_view']
 
+def test_metadata_snapshot(db, tmpdir):
+    snapshot_dir = str(tmpdir)
+    cold = DBMeta(db.conn_str, snapshot_dir=snapshot_dir)
+    cold.fetch_metadata()
+    assert tmpdir.join('{}.meta'.format(db.conn_id)).check()
+
+    warm = DBMeta(db.conn_str, snapshot_dir=snapshot_dir)
+    assert warm.list_tables() == cold.list_tables()
+    assert warm.describe_table('test_user') == cold.describe_table('test_user')
+
+def test_refresh_metadata(db):
+    db.fetch_metadata()
+    assert db.refresh_metadata() == {'schemas': [], 'tables': []}
+    db.conn.execute("create table test_refresh (id integer)")
+    try:
+        assert db.refresh_metadata() == {'schemas': ['public'], 'tables': []}
+        assert 'public.test_refresh' in db.list_tables()
+        db.conn.execute("alter table test_refresh add column name text")
+        db.refresh_metadata(tables=['test_refresh'])
+        assert db.describe_table('test_refresh') == [
+            {'field': 'id', 'type': 'integer'},
+            {'field': 'name', 'type': 'text'}
+            ]
+    finally:
+        db.conn.execute("drop table test_refresh")
+    db.refresh_metadata()
+    assert 'public.test_refresh' not in db.list_tables()
+
+def test_metadata_fetchers(db):
+    results = [cls(db.conn).fetch(schemas=['public'])
+               for cls in METADATA_FETCHERS.values()]
+    assert results[0] == results[1]
+    assert results[0]['public.test_user']['fields'][0] == {
+        'field': 'id', 'type': 'integer'}
+
+def test_complete(db):
+    assert db.complete('test_u') == [
+        {'name': 'test_user', 'table': 'public.test_user'},
+        {'name': 'test_user_view', 'table': 'public.test_user_view'},
+        ]
+    assert db.complete('e', context='column', table='test_user') == [
+        {'name': 'email', 'type': 'text', 'table': 'public.test_user'}]
+
 def test_describe_table(db):
     result = db.describe_table('test_user')
     assert result == [
@@ -48,6 +96,51 @@ def test_describe_field(db):
     assert height['max'] == approx(199.92, 0.1)
     assert height['distinct_count'] == 1000
 
+def test_describe_field_single_scan(db):
+    for field in ('age', 'gender', 'height'):
+        assert db.describe_field('test_data', field)['scans'] == 1
+
+def test_describe_field_sample(db):
+    gender = db.describe_field('test_data', 'gender', sample='500',
+                               sample_method='bernoulli')
+    assert gender['approximate']
+    assert 0 < gender['sample_rows'] < 1000
+    assert gender['row_count'] == 1000
+    assert gender['distinct_count'] == 2
+    for item in gender['most_common']:
+        assert item['count_low'] <= item['count'] <= item['count_high']
+
+    age = db.describe_field('test_data', 'age', sample='50%',
+                            sample_method='bernoulli')
+    assert age['approximate']
+    assert age['distinct_count_low'] <= age['distinct_count']
+    assert age['distinct_count'] <= age['distinct_count_high']
+
+def test_describe_field_catalog(db):
+    db.conn.execute("analyze test_data")
+    gender = db.describe_field('test_data', 'gender', mode='catalog')
+    assert gender['source'] == 'catalog'
+    assert gender['scans'] == 0
+    assert gender['distinct_count'] == 2
+    assert gender['most_common'] == [
+        {'count': 503, 'value': u'male'},
+        {'count': 497, 'value': u'female'}
+    ]
+
+    age = db.describe_field('test_data', 'age', mode='catalog')
+    assert age['min'] == 10
+    assert age['max'] == 80
+
+def test_describe_field_cache(db):
+    db.invalidate()
+    db.describe_field('test_data', 'gender')
+    db.describe_field('test_data', 'gender')
+    stats = db.cache_stats()['stats']
+    assert stats['entries'] == 1
+    assert stats['hits'] >= 1
+    assert db.invalidate('test_data', 'gender') == 1
+    assert db.cache_stats()['stats']['entries'] == 0
+
 def test_run_sql(db):
     result = db.run_sql("select height, gender from test_data", limit=50)
     rowcount = result['rowcount']
@@ -55,3 +148,131 @@ def test_run_sql(db):
     assert rowcount == 1000
     assert len(result['rows']) == 50
     assert result['columns'] == ['height', 'gender']
+
+def test_run_sql_stream(db):
+    result = db.run_sql("select height, gender from test_data",
+                        limit=400, stream=True)
+    assert result['has_more']
+    assert len(result['rows']) == 400
+    assert result['columns'] == ['height', 'gender']
+
+    handle = result['handle']
+    result = db.fetch_more(handle, limit=400)
+    assert result['has_more']
+    assert len(result['rows']) == 400
+
+    result = db.fetch_more(handle, limit=400)
+    assert not result['has_more']
+    assert len(result['rows']) == 200
+    assert not db.close_cursor(handle)
+
+def test_materialize(db):
+    sql = "select gender, age from test_data where age >= 18"
+    table_name = db.materialize('adults', sql)
+    assert db.materialize('adults', sql) == table_name
+    result = db.run_sql("select count(*) from {}".format(table_name),
+                        session=True)
+    assert result['rows'][0][0] > 0
+    assert db.materialize('adults', sql + ' and age < 60') != table_name
+    assert db.drop_materialized('adults') == 1
+    db.materialize('adults', sql, ttl=0)
+    assert db.drop_expired_materialized() == 1
+    assert db.idle
+
+def test_limit_sql():
+    assert limit_sql("select * from t;", 10) == (
+        "select * from (\nselect * from t\n) as _q limit 10")
+    assert limit_sql("select * from t limit 5", 10) == (
+        "select * from t limit 5")
+    assert limit_sql("delete from t", 10) == "delete from t"
+    assert limit_sql("select 1; select 2", 10) == "select 1; select 2"
+    assert limit_sql("set search_path to public; select * from t", 10) == (
+        "set search_path to public; select * from t")
+    cte = "with d as (delete from t returning *) select * from d"
+    assert limit_sql(cte, 10) == cte
+    assert not is_read_only(cte)
+    assert limit_sql("select * from t; -- all rows", 10) == (
+        "select * from (\nselect * from t\n) as _q limit 10")
+
+def test_normalize_sql():
+    assert normalize_sql("select  'a  --b' -- all\n from t /* x */;\n") == (
+        "select 'a  --b' from t")
+
+def test_run_sql_push_limit(db):
+    result = db.run_sql("select height, gender from test_data", limit=50,
+                        push_limit=True, count=True)
+    assert result['rowcount'] == 50
+    assert result['total_count'] == 1000
+
+def test_run_many(db):
+    results = db.run_many([
+        ('heights', "select height from test_data"),
+        ('broken', "select nothing from test_data"),
+        ('genders', "select distinct gender from test_data"),
+        ], limit=10)
+    assert [r['name'] for r in results] == ['heights', 'broken', 'genders']
+    assert len(results[0]['rows']) == 10
+    assert 'nothing' in results[1]['error']
+    assert all(r['elapsed'] >= 0 for r in results)
+
+def test_pool_search_path(db):
+    with db.connection() as conn1, db.connection() as conn2:
+        for conn in (conn1, conn2):
+            assert conn.execute("show search_path").scalar() == 'public'
+
+def test_reconnect(db):
+    assert DBMeta.get_instance(db.conn_id) is db
+    assert DBMeta.create_instance(db.conn_str) is db
+    db.reconnect()
+    assert db.run_sql("select 1")['rows'] == [[1]]
+
+def test_run_sql_cache(db):
+    db.invalidate_results()
+    sql = "select height, gender from test_data"
+    result = db.run_sql(sql, limit=10, cache=True)
+    assert 'cached' not in result
+    result = db.run_sql(sql + ";\n", limit=10, cache=True)
+    assert result['cached'] and result['cache_age'] >= 0
+    assert len(result['rows']) == 10
+    assert db.cache_stats()['results']['entries'] == 1
+    db.run_sql("create temporary table cache_test as select 1 as a")
+    assert db.cache_stats()['results']['entries'] == 0
+    cte = ("with d as (delete from cache_test returning *) "
+           "select * from d")
+    assert db.run_sql(cte, cache=True)['rows'] == [[1]]
+    result = db.run_sql(cte, cache=True)
+    assert 'cached' not in result and 'rows' not in result
+
+def test_statement_timeout(db):
+    with pytest.raises(Exception) as e:
+        db.run_sql("select pg_sleep(1)", timeout=10)
+    assert 'statement timeout' in str(e.value)
+    assert db.run_sql("select 1", timeout=1000)['rows'] == [[1]]
+    with pytest.raises(Exception) as e:
+        db.run_sql("select pg_sleep(1)", stream=True, timeout=10)
+    assert 'statement timeout' in str(e.value)
+
+def test_cost_guardrails(db):
+    guarded = DBMeta(db.conn_str, max_rows=100)
+    sql = "select * from test_data"
+    assert guarded.explain(sql)['Plan Rows'] > 100
+    with pytest.raises(QueryTooExpensive):
+        guarded.run_sql(sql)
+    result = guarded.run_sql(sql, limit=10, push_limit=True)
+    assert len(result['rows']) == 10
+    result = guarded.run_sql(sql, limit=10, confirm=True)
+    assert len(result['rows']) == 10
+    guarded.close()
+
+def test_count_cost_guardrail(db):
+    sql = "select * from test_data"
+    limited_cost = db.explain(limit_sql(sql, 10))['Total Cost']
+    guarded = DBMeta(db.conn_str, max_cost=limited_cost)
+    result = guarded.run_sql(sql, limit=10, push_limit=True)
+    assert len(result['rows']) == 10
+    with pytest.raises(QueryTooExpensive):
+        guarded.run_sql(sql, limit=10, push_limit=True, count=True)
+    result = guarded.run_sql(sql, limit=10, push_limit=True, count=True,
+                             confirm=True)
+    assert result['total_count'] > 10
+    guarded.close()
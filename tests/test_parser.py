@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+
+from yamlsql.parser import YAMLParser, split_items
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def test_split_items():
+    content = open(os.path.join(DATA_DIR, 'simple.yaml')).read()
+    items = split_items(content)
+    assert [lineno for lineno, _ in items] == [1, 4]
+    assert ''.join(source for _, source in items) == content
+    for lineno, source in items:
+        item = YAMLParser(content).find_root(lineno)
+        assert YAMLParser(source).doc[0] == item
+
+
+def test_split_items_fallback():
+    assert split_items("- &base\n  sql: select 1\n- *base\n") is None
+    assert split_items("name: query1\nsql: select 1\n") is None
+    assert split_items("[{sql: select 1}]\n") is None
+    assert split_items("- sql: select *, 1 from t\n") is not None
+
+
+def test_line_paths():
+    content = open(os.path.join(DATA_DIR, 'simple.yaml')).read()
+    parser = YAMLParser(content)
+    paths = parser.line_paths()
+    assert len(paths) == len(content.splitlines())
+    assert paths == [parser.find_path(lineno)
+                     for lineno in xrange(1, len(paths) + 1)]
+    assert paths[6] == [1, 'select', 0]
@@ -5,7 +5,9 @@ from pprint import pprint
 
 import pytest
 
-from yamlsql.render import SQLRender, sql_format
+from yamlsql.render import (SQLRender, Processor, SqlProcessor,
+                            SelectProcessor, sql_format, get_render,
+                            RENDER_CACHE, ITEM_CACHE)
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
 
@@ -33,3 +35,139 @@ def test_render(simple_render):
     assert sql == sql_format(
         "select * from public.test_data;"
         "select gender,age from public.test_data;")
+
+
+def test_sql_format_modes():
+    sql = """
+    select gender from public.test_data
+
+    limit 10   """
+    assert sql_format(sql, 'fast') == "select gender from public.test_data\nlimit 10;"
+    assert sql_format(sql, 'none') == sql.strip() + ';'
+    assert sql_format(sql) == sql_format(sql, 'pretty')
+    with pytest.raises(ValueError):
+        sql_format(sql, 'ugly')
+
+
+def test_render_format_mode():
+    content = open(os.path.join(DATA_DIR, 'simple.yaml')).read()
+    render = SQLRender(content, format_mode='fast')
+    assert render.render(lineno=5) == \
+        "select gender,age from public.test_data\nlimit 10;"
+
+
+def test_render_cache():
+    content = open(os.path.join(DATA_DIR, 'simple.yaml')).read()
+    render = get_render(content)
+    sql = render.render(lineno=5)
+    hits = RENDER_CACHE.hits
+    assert get_render(content) is render
+    assert RENDER_CACHE.hits == hits + 1
+    assert render.render(lineno=5) is sql
+    assert get_render(content + '\n') is not render
+
+
+def test_render_partial(simple_render):
+    sql = simple_render.render(lineno=5)
+    assert sql == sql_format("select gender,age from public.test_data limit 10")
+    assert simple_render.render(query_name='query1') == sql_format(
+        "select * from public.test_data")
+    # only the items around the line were parsed
+    assert simple_render._parser is None
+
+
+def test_render_item_cache():
+    content = ''.join('- name: q{0}\n  sql: select {0}\n\n'.format(i)
+                      for i in range(150))
+    render = get_render(content, format_mode='none')
+    render.render()
+    hits = ITEM_CACHE.hits
+    edited = get_render(content.replace('select 0', 'select -1'),
+                        format_mode='none')
+    edited.render()
+    assert ITEM_CACHE.hits - hits == 149
+    assert get_render(content, format_mode='none') is render
+
+
+class CountProcessor(Processor):
+    when = 'count'
+
+    def transform(self, item):
+        return {'sql': 'select count(*) from {}'.format(item['count'])}
+
+
+class LoopProcessor(Processor):
+    when = 'loop'
+
+    def transform(self, item):
+        return item
+
+
+def test_custom_processor():
+    render = SQLRender("- count: public.test_data\n",
+                       [SqlProcessor, SelectProcessor, CountProcessor])
+    assert render.render() == sql_format("select count(*) from public.test_data")
+
+
+class TopProcessor(Processor):
+    when = 'top'
+
+    def process(self, item):
+        item = dict(item)
+        item['limit'] = item.pop('top')
+        return item
+
+
+def test_custom_process():
+    render = SQLRender("- select: [id]\n  from: public.test_data\n  top: 5\n",
+                       [SqlProcessor, TopProcessor, SelectProcessor],
+                       format_mode='none')
+    assert 'limit 5' in render.render()
+
+
+def test_processor_loop():
+    render = SQLRender("- loop: 1\n", [SqlProcessor, LoopProcessor])
+    with pytest.raises(Exception) as e:
+        render.render()
+    assert 'looping' in str(e.value)
+
+
+def test_render_references():
+    content = open(os.path.join(DATA_DIR, 'references.yaml')).read()
+    render = SQLRender(content, format_mode='none')
+    assert render.render(query_name='adult_genders_share') == (
+        "with adults as (\n"
+        "select gender, age from public.test_data where age >= 18\n"
+        "),\n"
+        "adult_genders as (\n"
+        "select gender, count(*) from adults group by 1\n"
+        ")\n"
+        "select g.gender, g.count * 1.0 / (select count(*) from adults)\n"
+        "from adult_genders g;")
+    assert render.render(lineno=4).startswith("with adults as (")
+
+
+def test_render_cyclic_references():
+    render = SQLRender("- name: a\n  with: b\n  sql: select 1\n"
+                       "- name: b\n  with: a\n  sql: select 2\n")
+    with pytest.raises(Exception) as e:
+        render.render(query_name='a')
+    assert 'a -> b -> a' in str(e.value)
+
+
+def test_render_materialized_references():
+    content = open(os.path.join(DATA_DIR, 'references.yaml')).read()
+    content = content.replace("- name: adults\n",
+                              "- name: adults\n  materialize: 60\n")
+    render = SQLRender(content, format_mode='none')
+    assert render.materialized_refs(query_name='adult_genders') == ['adults']
+    assert render.materialize_ttl('adults') == 60
+    sql = render.render(query_name='adult_genders',
+                        overrides={'adults': 'select * from tmp_adults'})
+    assert sql.startswith("with adults as (\nselect * from tmp_adults\n)")
+
+
+def test_render_list(simple_render):
+    queries = simple_render.render_list()
+    assert [name for name, _ in queries] == ['query1', 'query2']
+    assert queries[0][1].startswith('SELECT')
@@ -1,5 +1,6 @@
 import os
 import json
+import time
 import urllib
 
 import pytest
@@ -78,3 +79,50 @@ def test_api_run_sql(client, conn_id, content):
     data = result['data']
     assert data['rowcount'] == 1000
     assert len(data['rows']) == 50
+
+def test_api_run_sql_async(client, conn_id, content):
+    result = json_post(client, '/run_sql?async=1', {
+        'conn_id': conn_id,
+        'content': content,
+        'lineno': 1,
+        'limit': 50
+        })
+    job_id = result['data']['job_id']
+    for _ in xrange(50):
+        status = json_get(client, '/job_status', {'job_id': job_id})
+        if status['data']['status'] not in ('pending', 'running'):
+            break
+        time.sleep(0.1)
+    assert status['data']['status'] == 'done'
+    result = json_get(client, '/job_result', {'job_id': job_id})
+    assert len(result['data']['rows']) == 50
+
+def test_api_render_buffer(client, content):
+    result = json_post(client, '/open_buffer', {'content': content})
+    buffer_id = result['data']['buffer_id']
+    result = json_post(client, '/update_buffer', {
+        'buffer_id': buffer_id,
+        'version': 0,
+        'edits': [{'start': 9, 'end': 10, 'text': '  limit: 5'}]
+        })
+    assert result['data']['version'] == 1
+    result = json_post(client, '/render_sql', {
+        'buffer_id': buffer_id,
+        'lineno': 5
+        })
+    assert result['data']['sql'].endswith('LIMIT 5;')
+
+def test_api_connections(client, conn_id):
+    result = json_get(client, '/connections', None)
+    pools = result['data']['connections']
+    assert conn_id in [pool['conn_id'] for pool in pools]
+
+def test_api_explain(client, conn_id, content):
+    result = json_post(client, '/explain', {
+        'conn_id': conn_id,
+        'content': content,
+        'lineno': 1
+        })
+    data = result['data']
+    assert data['plan']['Node Type'] == 'Seq Scan'
+    assert data['rows'] > 0
@@ -33,6 +33,13 @@ def api_request(func):
     return response
 
 
+def as_bool(value):
+    """ Parse a boolean flag passed as query string or JSON value """
+    if isinstance(value, basestring):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
 def emacs_converter(processor):
     @decorator
     def converter(func):
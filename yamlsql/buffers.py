@@ -0,0 +1,79 @@
+""" Editor buffers kept on the server, so that clients send line edits
+instead of the whole content on every request. """
+from threading import Lock
+from uuid import uuid4
+
+from . import errors
+from .cache import LRUCache
+
+MAX_BUFFERS = 100
+# Seconds after its last update a buffer is dropped
+BUFFER_TTL = 3600
+
+
+class Buffer(object):
+    def __init__(self, content):
+        self.buffer_id = uuid4().hex
+        self.lines = content.splitlines(True)
+        self.version = 0
+        self._lock = Lock()
+
+    @property
+    def content(self):
+        return ''.join(self.lines)
+
+    def apply(self, edits, version=None):
+        """ Apply `edits` in order and return the new version.
+
+        Each edit replaces lines `start` to `end` (excluded, starting with
+        1) with `text`; `start == end` inserts lines. If `version` is given
+        and is not the current version, the edits are rejected so that the
+        client resends the whole content.
+        """
+        with self._lock:
+            if version is not None and int(version) != self.version:
+                raise errors.BufferOutOfDate(self.buffer_id)
+            lines = list(self.lines)
+            for edit in edits:
+                start, end = int(edit['start']) - 1, int(edit['end']) - 1
+                if not 0 <= start <= end <= len(lines):
+                    raise ValueError('Invalid edit range: {}-{}'.format(
+                        edit['start'], edit['end']))
+                text = edit.get('text', '')
+                if text and not text.endswith('\n') and end < len(lines):
+                    text += '\n'
+                lines[start:end] = text.splitlines(True)
+            self.lines = lines
+            self.version += 1
+            return self.version
+
+    def to_dict(self):
+        return {'buffer_id': self.buffer_id, 'version': self.version}
+
+
+BUFFERS = LRUCache(MAX_BUFFERS, BUFFER_TTL)
+
+
+def open_buffer(content):
+    buf = Buffer(content)
+    BUFFERS.set(buf.buffer_id, buf)
+    return buf
+
+
+def get_buffer(buffer_id):
+    buf = BUFFERS.get(buffer_id)
+    if buf is None:
+        raise errors.BufferNotFound(buffer_id)
+    return buf
+
+
+def update_buffer(buffer_id, edits, version=None):
+    buf = get_buffer(buffer_id)
+    buf.apply(edits, version)
+    # re-insert to restart its lifetime
+    BUFFERS.set(buffer_id, buf)
+    return buf
+
+
+def close_buffer(buffer_id):
+    return BUFFERS.invalidate(lambda key: key == buffer_id) > 0
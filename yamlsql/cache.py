@@ -0,0 +1,80 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """ Thread-safe LRU cache. Entries expire `ttl` seconds after they are
+    set, or never if `ttl` is None. Once `max_entries` is reached, or the
+    total size of entries exceeds `max_size`, the least recently used
+    entries are evicted.
+    """
+    def __init__(self, max_entries=1000, ttl=None, max_size=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _expired(self, entry, now):
+        return self.ttl is not None and now - entry[1] > self.ttl
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or self._expired(entry, time.time()):
+                if entry is not None:
+                    self.size -= entry[2]
+                self.misses += 1
+                return default
+            # re-insert to mark it as the most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size=0):
+        """ Store `value`. `size` counts against `max_size`; a value larger
+        than `max_size` is not stored. """
+        with self._lock:
+            self._remove(key)
+            if self.max_size is not None and size > self.max_size:
+                return
+            self._data[key] = (value, time.time(), size)
+            self.size += size
+            while len(self._data) > self.max_entries or (
+                    self.max_size is not None and self.size > self.max_size):
+                _, entry = self._data.popitem(last=False)
+                self.size -= entry[2]
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def invalidate(self, predicate=None):
+        """ Remove the entries whose key matches `predicate`, or all entries
+        if it is None. Returns the number of removed entries. """
+        with self._lock:
+            keys = [k for k in self._data if predicate is None or predicate(k)]
+            for k in keys:
+                self._remove(k)
+        return len(keys)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'max_entries': self.max_entries,
+            'size': self.size,
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else None
+            }
@@ -1,8 +1,19 @@
 #!/usr/bin/env python
+import io
+import json
+import os
+import sys
+from multiprocessing import Pool, cpu_count
+
 import click
 
+from yamlsql.render import FORMAT_MODES, SQLRender, content_hash
 from yamlsql.server import app
 
+YAML_EXTENSIONS = ('.yaml', '.yml')
+
+MANIFEST_NAME = '.yamlsql-manifest.json'
+
 @click.group()
 def cli():
     pass
@@ -13,5 +24,110 @@ def cli():
 def runserver(port, debug):
     app.run(port=port, debug=debug)
 
+def find_files(paths):
+    """ Yield (path, output name) of the YAML files in `paths`, walking
+    directories. The output name is relative to the directory given. """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path, os.path.basename(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(YAML_EXTENSIONS):
+                    full_path = os.path.join(root, name)
+                    yield full_path, os.path.relpath(full_path, path)
+
+def render_file(args):
+    """ Render every query in a file. Returns (path, sql, error) """
+    path, content, format_mode = args
+    try:
+        sql = SQLRender(content, format_mode=format_mode).render()
+        return path, sql, None
+    except Exception as e:
+        return path, None, '{}: {}'.format(type(e).__name__, e)
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(path, manifest):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+@cli.command(help='Render queries in YAML files or directories to SQL')
+@click.argument('paths', nargs=-1, required=True,
+                type=click.Path(exists=True))
+@click.option('--out-dir', type=click.Path(file_okay=False),
+              help='Write a .sql file per YAML file instead of stdout')
+@click.option('--jobs', '-j', default=cpu_count(),
+              help='Number of render processes')
+@click.option('--format-mode', default='pretty',
+              type=click.Choice(FORMAT_MODES))
+@click.option('--force/--no-force', default=False,
+              help='Render files which did not change since the last run')
+def render(paths, out_dir, jobs, format_mode, force):
+    if out_dir and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    manifest_path = out_dir and os.path.join(out_dir, MANIFEST_NAME)
+    manifest = {} if force or not out_dir else load_manifest(manifest_path)
+    tasks, outputs, hashes, sources = [], {}, {}, {}
+    for path, name in find_files(paths):
+        with io.open(path, encoding='utf-8') as f:
+            content = f.read()
+        if out_dir:
+            out_path = os.path.join(
+                out_dir, os.path.splitext(name)[0] + '.sql')
+            # e.g. files of the same name given from different directories
+            if out_path in sources:
+                raise click.UsageError('{} and {} both render to {}'.format(
+                    sources[out_path], path, out_path))
+            sources[out_path] = path
+            # the format mode changes the output as much as the content
+            hashes[path] = content_hash(content + format_mode)
+            if manifest.get(out_path) == hashes[path] \
+                    and os.path.exists(out_path):
+                continue
+            outputs[path] = out_path
+        tasks.append((path, content, format_mode))
+
+    if jobs > 1 and len(tasks) > 1:
+        pool = Pool(min(jobs, len(tasks)))
+        results = pool.imap(render_file, tasks, chunksize=16)
+    else:
+        pool = None
+        results = (render_file(task) for task in tasks)
+
+    errors = 0
+    try:
+        for path, sql, error in results:
+            if error:
+                errors += 1
+                click.echo('{}: {}'.format(path, error), err=True)
+            elif not out_dir:
+                click.echo(sql)
+            else:
+                out_path = outputs[path]
+                if not os.path.isdir(os.path.dirname(out_path)):
+                    os.makedirs(os.path.dirname(out_path))
+                with io.open(out_path, 'w', encoding='utf-8') as f:
+                    f.write(sql + u'\n')
+                manifest[out_path] = hashes[path]
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if out_dir:
+            save_manifest(manifest_path, manifest)
+
+    if out_dir:
+        click.echo('{} rendered, {} unchanged, {} failed'.format(
+            len(tasks) - errors, len(hashes) - len(tasks), errors), err=True)
+    if errors:
+        sys.exit(1)
+
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,91 @@
+from bisect import bisect_left
+
+# Number of matches ranked before keeping the `limit` best ones. Matches
+# are taken in alphabetical order beyond this, so a very short prefix does
+# not rank a whole catalog.
+MAX_CANDIDATES = 1000
+
+
+def _prefix_range(entries, prefix):
+    """ Return entries whose first item starts with `prefix`. `entries` is
+    sorted, so they are contiguous and found with bisect. """
+    start = bisect_left(entries, (prefix,))
+    end = bisect_left(entries, (prefix + u'\uffff',), start)
+    return entries[start:min(end, start + MAX_CANDIDATES)]
+
+
+class CompletionIndex(object):
+    """ Prefix index of table and column names built from DBMeta metadata.
+
+    Tables are kept in one sorted array per schema, so a refresh only
+    rebuilds the schemas which changed. Column arrays are built the first
+    time a table is completed.
+    """
+    def __init__(self, search_path):
+        self.search_path = search_path
+        self._meta = {}
+        self._tables = {}
+        self._columns = {}
+
+    def update(self, meta, schemas=None, tables=None):
+        """ Rebuild the index for `schemas` and `tables` from `meta`, or
+        rebuild it entirely if neither is given """
+        if schemas is None and tables is None:
+            schemas = set(name.split('.', 1)[0] for name in meta)
+            self._tables = {}
+        changed = set(schemas or []) | set(
+            name.split('.', 1)[0] for name in tables or [])
+        by_schema = dict((schema, []) for schema in changed)
+        for name in meta:
+            schema, table = name.split('.', 1)
+            if schema in by_schema:
+                by_schema[schema].append((table.lower(), name))
+        self._meta = meta
+        table_index = dict(self._tables)
+        for schema, entries in by_schema.items():
+            entries.sort()
+            table_index[schema] = entries
+        self._tables = table_index
+        self._columns = dict(
+            (name, columns) for name, columns in self._columns.items()
+            if name.split('.', 1)[0] not in changed)
+
+    def _rank_schema(self, schema):
+        if schema in self.search_path:
+            return self.search_path.index(schema)
+        return len(self.search_path)
+
+    def tables(self, prefix, limit=50):
+        """ Return tables whose name, or qualified name if `prefix` contains
+        a schema, starts with `prefix`. Exact matches come first, then
+        tables in search path order, then shorter names. """
+        prefix = prefix.lower()
+        if '.' in prefix:
+            schema, prefix = prefix.split('.', 1)
+            schemas = [s for s in self._tables if s.lower() == schema]
+        else:
+            schemas = self._tables.keys()
+        matches = []
+        for schema in schemas:
+            rank = self._rank_schema(schema)
+            for key, name in _prefix_range(self._tables[schema], prefix):
+                matches.append(
+                    ((key != prefix, rank, len(key), key),
+                     {'name': name.split('.', 1)[1], 'table': name}))
+        matches.sort(key=lambda m: m[0])
+        return [m[1] for m in matches[:limit]]
+
+    def columns(self, table, prefix, limit=50):
+        """ Return columns of `table` (a qualified name) starting with
+        `prefix`. Exact matches come first, then shorter names. """
+        entries = self._columns.get(table)
+        if entries is None:
+            entries = sorted(
+                (f['field'].lower(), f['field'], f['type'])
+                for f in self._meta[table]['fields'])
+            self._columns[table] = entries
+        prefix = prefix.lower()
+        matches = sorted(_prefix_range(entries, prefix),
+                         key=lambda e: (e[0] != prefix, len(e[0]), e[0]))
+        return [{'name': field, 'type': type_, 'table': table}
+                for _, field, type_ in matches[:limit]]
@@ -1,30 +1,150 @@
-from hashlib import md5
+import os
+import time
+from contextlib import contextmanager
+from threading import RLock
 
-from sqlalchemy import create_engine
+from . import errors
 
+# Most database connections all registered pools may open together
+MAX_CONNECTIONS = int(os.environ.get('YAMLSQL_MAX_CONNECTIONS', 100))
+# Seconds an unused connection is kept with its metadata
+IDLE_TIMEOUT = 1800
+
+# DBMeta of each connection, by conn_id
 CONN_MAP = {}
+_registry_lock = RLock()
+
+def create_conn(conn_string, search_path=None, **options):
+    """ Return the DBMeta connected to `conn_string`, creating it if it
+    does not exist yet. `options` are passed to DBMeta.
+
+    Idle connections are evicted to keep the pools of all connections
+    within MAX_CONNECTIONS. """
+    return _create_conn(conn_string, search_path, options)
+
+@contextmanager
+def connecting(conn_string, search_path=None, **options):
+    """ Like `create_conn`, but the DBMeta is not evicted until the block
+    exits, e.g. while its metadata loads """
+    db = _create_conn(conn_string, search_path, options, hold=True)
+    try:
+        yield db
+    finally:
+        db.release()
+
+def _create_conn(conn_string, search_path, options, hold=False):
+    # dbmeta uses this registry, import it late
+    from .dbmeta import DBMeta, build_conn_id
+    conn_id = build_conn_id(conn_string)
+    evict_idle()
+    closed = []
+    try:
+        with _registry_lock:
+            db = CONN_MAP.get(conn_id)
+            if db is None:
+                db = DBMeta(conn_string, search_path, **options)
+                try:
+                    closed = _make_room(db.capacity)
+                except errors.ConnectionLimitReached:
+                    db.close()
+                    raise
+                CONN_MAP[conn_id] = db
+            db.last_used = time.time()
+            if hold:
+                db.acquire()
+    finally:
+        for removed in closed:
+            removed.close()
+    return db
+
+def _make_room(capacity):
+    """ Remove least recently used idle connections from the registry until
+    `capacity` more connections fit. Returns the removed DBMeta, which the
+    caller closes once it released `_registry_lock`. """
+    # Caller must hold `_registry_lock`
+    used = sum(db.capacity for db in CONN_MAP.values())
+    idle = sorted((db for db in CONN_MAP.values() if db.idle),
+                  key=lambda db: db.last_used)
+    removed = []
+    while used + capacity > MAX_CONNECTIONS and idle:
+        db = idle.pop(0)
+        used -= db.capacity
+        removed.append(CONN_MAP.pop(db.conn_id))
+    if used + capacity > MAX_CONNECTIONS:
+        for db in removed:
+            CONN_MAP[db.conn_id] = db
+        raise errors.ConnectionLimitReached(
+            "Too many open connections: {} of {} in use".format(
+                used, MAX_CONNECTIONS))
+    return removed
 
-def create_conn(conn_string, search_path=None):
-    conn_id = md5(conn_string).hexdigest()
-    conn = create_engine(conn_string)
-    search_path = search_path or ['public']
-    CONN_MAP[conn_id] = {
-        "conn_obj": conn,
-        "conn_string": conn_string,
-        "search_path": search_path
-    }
-    conn.execute("set search_path to {};".format(','.join(search_path)))
-    return conn_id
+def evict_idle(timeout=IDLE_TIMEOUT):
+    """ Close connections which have been idle for `timeout` seconds.
+    Returns their ids. """
+    # the registry is only locked to pick connections, dropping tables and
+    # closing pools talk to the databases
+    with _registry_lock:
+        dbs = list(CONN_MAP.values())
+    # expired materialized results do not keep connections open
+    for db in dbs:
+        db.drop_expired_materialized()
+    deadline = time.time() - timeout
+    with _registry_lock:
+        evicted = [conn_id for conn_id, db in CONN_MAP.items()
+                   if db.idle and db.last_used < deadline]
+        closed = [CONN_MAP.pop(conn_id) for conn_id in evicted]
+    for db in closed:
+        db.close()
+    return evicted
+
+def get_db(conn_id):
+    """ Return the DBMeta of `conn_id`, or None """
+    return CONN_MAP.get(conn_id)
+
+def _require_db(conn_id):
+    db = get_db(conn_id)
+    if db is None:
+        raise errors.ConnectionNotFound(
+            "Invalid Connection: {}".format(conn_id))
+    return db
+
+@contextmanager
+def using(conn_id):
+    """ Yield the DBMeta of `conn_id`, which is not evicted until the block
+    exits """
+    with _registry_lock:
+        db = _require_db(conn_id)
+        db.acquire()
+    try:
+        yield db
+    finally:
+        db.release()
 
 def get_conn(conn_id):
-    if conn_id not in CONN_MAP:
-        raise Exception("Invalid Connection: {}".format(conn_id))
-    return CONN_MAP[conn_id]['conn_obj']
+    return _require_db(conn_id).conn
 
 def get_search_path(conn_id):
-    if conn_id not in CONN_MAP:
-        raise Exception("Invalid Connection: {}".format(conn_id))
-    return CONN_MAP[conn_id]['search_path']
+    return _require_db(conn_id).search_path
 
 def reconnect(conn_id):
-    pass
+    """ Drop all pooled connections of `conn_id` and connect again """
+    _require_db(conn_id).reconnect()
+
+def close_conn(conn_id):
+    """ Remove `conn_id` from the registry and close its connections """
+    with _registry_lock:
+        db = CONN_MAP.pop(conn_id, None)
+    if db is not None:
+        db.close()
+    return db is not None
+
+def connections():
+    """ Pool usage of every connection """
+    evict_idle()
+    with _registry_lock:
+        pools = [db.pool_status() for db in CONN_MAP.values()]
+    return {
+        'connections': pools,
+        'capacity': sum(pool['capacity'] for pool in pools),
+        'max_connections': MAX_CONNECTIONS
+        }
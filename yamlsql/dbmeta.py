@@ -1,11 +1,26 @@
+import json
+import math
+import re
+import time
+import traceback
+from contextlib import contextmanager
+from copy import deepcopy
 from hashlib import md5
-from threading import Lock
+from multiprocessing.pool import ThreadPool
+from threading import BoundedSemaphore, Lock, RLock, Thread
+from uuid import uuid4
 
+import sqlparse
+from sqlparse import tokens as T
 from funcy import decorator
-from sqlalchemy import text, create_engine
+from sqlalchemy import text, bindparam, create_engine, event
 from sqlalchemy.exc import ResourceClosedError
 
 from . import errors
+from .cache import LRUCache
+from .complete import CompletionIndex
+from .connection import create_conn, get_db
+from .snapshot import SNAPSHOT_DIR, load_snapshot, save_snapshot
 
 SQL_FETCH_METADATA = text("""
 select
@@ -13,32 +28,217 @@ select
 from
   information_schema.columns
 where
- table_schema not in ('information_schema', 'pg_catalog')
+ table_schema in :schemas
 order by
  table_schema, table_name, ordinal_position
-""")
+""").bindparams(bindparam('schemas', expanding=True))
 
-SQL_COUNT_DISTINCT = "select count(distinct {field_name}) from {table_name}"
+SQL_FETCH_TABLES_METADATA = text("""
+select
+  table_schema, table_name, column_name, data_type
+from
+  information_schema.columns
+where
+ table_schema || '.' || table_name in :tables
+order by
+ table_schema, table_name, ordinal_position
+""").bindparams(bindparam('tables', expanding=True))
 
-SQL_MOST_COMMON = """
-select {field_name}, count(*) as cnt from {table_name}
+# One marker per schema which changes whenever a table or a column of the
+# schema is added, dropped or altered.
+SQL_FETCH_MARKERS = text("""
+select table_schema as schema_name, count(*) as marker
+from information_schema.columns
+where table_schema in :schemas
 group by 1
-order by 2 desc
-limit {limit}
+""").bindparams(bindparam('schemas', expanding=True))
+
+# Same as above, reading pg_catalog directly instead of the
+# information_schema views and their privilege checks. Types are formatted
+# without modifiers to match `information_schema.columns.data_type`.
+SQL_PG_COLUMNS = """
+select
+  n.nspname as table_schema,
+  c.relname as table_name,
+  a.attname as column_name,
+  format_type(a.atttypid, null) as data_type
+from pg_attribute a
+join pg_class c on c.oid = a.attrelid
+join pg_namespace n on n.oid = c.relnamespace
+where a.attnum > 0
+  and not a.attisdropped
+  and c.relkind in ('r', 'v', 'm', 'f', 'p')
+  and {condition}
+order by n.nspname, c.relname, a.attnum
 """
 
-SQL_NUMERIC_STATS = """
+SQL_PG_FETCH_METADATA = text(SQL_PG_COLUMNS.format(
+    condition="n.nspname in :schemas"
+)).bindparams(bindparam('schemas', expanding=True))
+
+SQL_PG_FETCH_TABLES_METADATA = text(SQL_PG_COLUMNS.format(
+    condition="n.nspname || '.' || c.relname in :tables"
+)).bindparams(bindparam('tables', expanding=True))
+
+SQL_PG_FETCH_MARKERS = text("""
 select
-  min({field_name}) as min,
-  max({field_name}) as max,
-  avg({field_name}) as avg
-from {table_name}
+  n.nspname as schema_name,
+  count(*) || ':' || max(c.oid::bigint) || ':'
+    || sum(hashtext(c.relname || '.' || a.attname || '.' || a.atttypid))
+    as marker
+from pg_attribute a
+join pg_class c on c.oid = a.attrelid
+join pg_namespace n on n.oid = c.relnamespace
+where a.attnum > 0
+  and not a.attisdropped
+  and c.relkind in ('r', 'v', 'm', 'f', 'p')
+  and n.nspname in :schemas
+group by 1
+""").bindparams(bindparam('schemas', expanding=True))
+
+# Distinct count, most common values and numeric stats of a field are
+# computed from a single scan: the table is aggregated once per value and
+# the other stats are window aggregates over these groups.
+SQL_FIELD_STATS = """
+with counts as (
+  select {field_name} as value, count(*) as cnt
+  from {source}
+  group by 1
+), stats as (
+  select
+    value,
+    cnt,
+    count(value) over () as distinct_count,
+    sum(cnt) over () as row_count,
+    sum(case when cnt = 1 and value is not null then 1 else 0 end)
+      over () as singletons{numeric_stats}
+  from counts
+)
+select * from stats
+order by cnt desc
+limit {limit}
 """
 
+SQL_NUMERIC_STATS = """,
+    min(value) over () as min,
+    max(value) over () as max,
+    sum(value::numeric * cnt) over ()
+      / sum(case when value is not null then cnt end) over () as avg"""
+
+# Planner statistics collected by ANALYZE, together with the number of rows
+# modified since then to tell whether they are stale.
+SQL_CATALOG_STATS = text("""
+select
+  s.n_distinct,
+  s.null_frac,
+  s.most_common_vals::text::text[] as most_common_vals,
+  s.most_common_freqs,
+  s.histogram_bounds::text::text[] as histogram_bounds,
+  c.reltuples::bigint as row_count,
+  coalesce(t.n_mod_since_analyze, 0) as n_mod_since_analyze
+from pg_stats s
+join pg_namespace n on n.nspname = s.schemaname
+join pg_class c on c.relnamespace = n.oid and c.relname = s.tablename
+left join pg_stat_all_tables t on t.relid = c.oid
+where s.schemaname = :schema_name
+  and s.tablename = :table_name
+  and s.attname = :field_name
+order by s.inherited
+limit 1
+""")
+
+# Planner statistics are considered stale once this fraction of the table
+# has been modified since the last ANALYZE
+CATALOG_STALE_RATIO = 0.2
+
+DESCRIBE_MODES = ('scan', 'catalog')
+
+SQL_ESTIMATE_ROWS = text("""
+select reltuples::bigint from pg_class where oid = cast(:table_name as regclass)
+""")
+
+SQL_COUNT_ROWS = "select count(*) from {table_name}"
+
+SQL_TABLESAMPLE = "{table_name} tablesample {method} ({percent})"
+
+SQL_LIMIT_SAMPLE = "(select * from {table_name} limit {rows}) as sample"
+
+# Dialects supporting `TABLESAMPLE SYSTEM/BERNOULLI`
+TABLESAMPLE_DIALECTS = ('postgresql',)
+TABLESAMPLE_METHODS = ('system', 'bernoulli')
+
+# z-score of the confidence bounds reported for sampled counts (95%)
+CONFIDENCE_Z = 1.96
+
+SQL_BACKEND_PID = text("select pg_backend_pid()")
+
+SQL_CANCEL_BACKEND = text("select pg_cancel_backend(:pid)")
+
+SQL_PUSH_LIMIT = "select * from (\n{sql}\n) as _q limit {limit}"
+
+SQL_COUNT = "select count(*) from (\n{sql}\n) as _q"
+
+SQL_SET_TIMEOUT = "set statement_timeout = {}"
+
+SQL_SET_LOCAL_TIMEOUT = "set local statement_timeout = {}"
+
+SQL_EXPLAIN = "explain (format json) {sql}"
+
+# Statements which EXPLAIN estimates without running them
+EXPLAINABLE_TYPES = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+
+# Classification of recently run SQL, see `sql_info`
+SQL_INFO_CACHE = LRUCache(1000)
+
+NORMALIZE_SQL = re.compile(
+    r"""(?P<quoted>'(?:[^']|'')*'|"(?:[^"]|"")*")"""
+    r"""|(?:\s|--[^\n]*|/\*.*?\*/)+""", re.S)
+
+# Default lifetime (seconds) and byte budget of cached query results
+RESULT_CACHE_TTL = 300
+RESULT_CACHE_SIZE = 50 * 1024 * 1024
+
+# Keywords of statements which change data
+DML_KEYWORDS = ('INSERT', 'UPDATE', 'DELETE')
+
+# Top-level keywords which make wrapping a SELECT change its results
+UNWRAPPABLE_KEYWORDS = ('LIMIT', 'FETCH', 'OFFSET', 'INTO', 'FOR')
+
+# Default lifetime (seconds) and size of the field stats cache
+STATS_CACHE_TTL = 600
+STATS_CACHE_SIZE = 1000
+
+# Default lifetime (seconds) of materialized query results
+MATERIALIZE_TTL = 600
+
+SQL_MATERIALIZE = "create temporary table {table_name} as {sql}"
+
+SQL_DROP_TABLE = "drop table if exists {table_name}"
+
+# Seconds a streaming result handle may stay unused before it is closed
+CURSOR_IDLE_TIMEOUT = 300
+CURSOR_REAP_INTERVAL = 30
+
+# Queries of one connection which may run at the same time in `run_many`,
+# and threads shared by all connections to run them
+MAX_CONCURRENCY = 4
+MULTI_WORKERS = 16
+
+# Attempts to open a connection while the database is unreachable,
+# waiting RECONNECT_BACKOFF seconds after the first one and doubling
+RECONNECT_RETRIES = 5
+RECONNECT_BACKOFF = 0.5
+
+# Pool settings used by create_engine when they are not set
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+
 
 @decorator
 def require_metadata(func):
-    func._args[0].fetch_metadata()
+    db = func._args[0]
+    if db._meta is None:
+        db.fetch_metadata()
     return func()
 
 
@@ -48,50 +248,490 @@ def is_numeric(field):
         'double precision'
         )
 
+def parse_sample(sample):
+    """ Parse a sample size. '10%' samples a percentage of the table,
+    '10000' samples a number of rows. Returns a (kind, size) tuple.
+    """
+    sample = str(sample).strip()
+    if sample.endswith('%'):
+        percent = float(sample[:-1])
+        if not 0 < percent <= 100:
+            raise ValueError('Invalid sample percentage: {}'.format(sample))
+        return 'percent', percent
+    rows = int(sample)
+    if rows <= 0:
+        raise ValueError('Invalid sample size: {}'.format(sample))
+    return 'rows', rows
+
+
+def parse_value(value, numeric):
+    """ Convert a value of a text array from the catalog back to a number
+    for numeric fields """
+    if value is None or not numeric:
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def count_bounds(count, sample_rows, total):
+    """ Scale a count observed in a sample up to the whole table and
+    return (estimate, low, high) using the normal approximation.
+    """
+    p = float(count) / sample_rows
+    margin = CONFIDENCE_Z * math.sqrt(p * (1 - p) / sample_rows)
+    return (
+        int(round(p * total)),
+        int(round(max(count, (p - margin) * total))),
+        int(round(min(total, (p + margin) * total))))
+
+
+class MetadataFetcher(object):
+    """ Fetch columns of tables and catalog markers through
+    information_schema, which works with most databases. """
+    name = 'information_schema'
+    sql_fetch_schemas = SQL_FETCH_METADATA
+    sql_fetch_tables = SQL_FETCH_TABLES_METADATA
+    sql_fetch_markers = SQL_FETCH_MARKERS
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def fetch(self, schemas=None, tables=None):
+        """ Return fields of all tables in `schemas`, or of `tables` """
+        if tables is not None:
+            rows = self.conn.execute(self.sql_fetch_tables, tables=tables)
+        else:
+            rows = self.conn.execute(self.sql_fetch_schemas, schemas=schemas)
+        meta = {}
+        for r in rows:
+            table_name = "{}.{}".format(r['table_schema'], r['table_name'])
+            table = meta.setdefault(table_name, {'fields': []})
+            table['fields'].append(
+                {'field': r['column_name'], 'type': r['data_type']}
+            )
+        return meta
+
+    def fetch_markers(self, schemas):
+        """ Return the marker of each schema, None for missing schemas """
+        markers = dict.fromkeys(schemas)
+        markers.update({
+            r['schema_name']: str(r['marker'])
+            for r in self.conn.execute(self.sql_fetch_markers, schemas=schemas)
+            })
+        return markers
+
+
+class PGCatalogFetcher(MetadataFetcher):
+    """ Fetch metadata from pg_catalog, which is much faster than
+    information_schema on Postgres databases with large catalogs. """
+    name = 'pg_catalog'
+    sql_fetch_schemas = SQL_PG_FETCH_METADATA
+    sql_fetch_tables = SQL_PG_FETCH_TABLES_METADATA
+    sql_fetch_markers = SQL_PG_FETCH_MARKERS
+
+
+METADATA_FETCHERS = {
+    MetadataFetcher.name: MetadataFetcher,
+    PGCatalogFetcher.name: PGCatalogFetcher,
+    }
+
+# Fetcher used by default for each dialect
+DIALECT_FETCHERS = {
+    'postgresql': PGCatalogFetcher.name,
+    }
+
+
+def get_fetcher(conn, name=None):
+    """ Return the metadata fetcher called `name`, or the best one for the
+    dialect of `conn` """
+    name = name or DIALECT_FETCHERS.get(
+        conn.dialect.name, MetadataFetcher.name)
+    if name not in METADATA_FETCHERS:
+        raise ValueError('Invalid metadata fetcher: {}'.format(name))
+    return METADATA_FETCHERS[name](conn)
+
+
+def _is_code(token):
+    return not token.is_whitespace and token.ttype not in T.Comment \
+        and not token.match(T.Punctuation, ';')
+
+def _has_code(stmt):
+    return any(_is_code(token) for token in stmt.flatten())
+
+def sql_statements(sql):
+    """ Statements of `sql`, skipping empty and comment-only ones """
+    return [stmt for stmt in sqlparse.parse(sql) if _has_code(stmt)]
+
+def sql_hash(sql):
+    if isinstance(sql, unicode):
+        sql = sql.encode('utf-8')
+    return md5(sql).hexdigest()
+
+def sql_info(sql):
+    """ Classify `sql` with a single parse, memoized by its hash. Returns
+    a dict with `select_body` (see `select_body`), `read_only` and
+    `explainable`. """
+    key = sql_hash(sql)
+    info = SQL_INFO_CACHE.get(key)
+    if info is None:
+        statements = sql_statements(sql)
+        info = {
+            'select_body': _select_body(statements),
+            'read_only': all(_is_read_only(stmt) for stmt in statements),
+            'explainable': len(statements) == 1 and
+            statements[0].get_type() in EXPLAINABLE_TYPES
+            }
+        SQL_INFO_CACHE.set(key, info)
+    return info
+
+def _modifies_data(stmt):
+    # a SELECT may still change data in its WITH clause, and Postgres only
+    # accepts such a WITH clause at the top level
+    return any(token.ttype in T.Keyword.DML
+               and token.normalized in DML_KEYWORDS
+               for token in stmt.flatten())
+
+def _select_body(statements):
+    if len(statements) != 1 or statements[0].get_type() != 'SELECT' \
+            or _modifies_data(statements[0]):
+        return None
+    for token in statements[0].tokens:
+        if token.is_keyword and \
+                token.normalized.split()[0] in UNWRAPPABLE_KEYWORDS:
+            return None
+    # drop the semicolon and trailing comments, which cannot be wrapped
+    tokens = list(statements[0].flatten())
+    while not _is_code(tokens[-1]):
+        tokens.pop()
+    return ''.join(token.value for token in tokens).strip()
+
+def _is_read_only(stmt):
+    return stmt.get_type() == 'SELECT' and not any(
+        token.is_keyword and token.normalized == 'INTO'
+        for token in stmt.tokens) and not _modifies_data(stmt)
+
+def select_body(sql):
+    """ Return `sql` without its trailing semicolon if it is a single plain
+    SELECT which can be wrapped as a subquery, otherwise None. """
+    return sql_info(sql)['select_body']
+
+def is_read_only(sql):
+    """ Whether `sql` only has SELECT statements, which do not change
+    data """
+    return sql_info(sql)['read_only']
+
+def explainable(sql):
+    """ Whether `sql` is a single statement EXPLAIN can estimate """
+    return sql_info(sql)['explainable']
+
+def normalize_sql(sql):
+    """ Strip comments and redundant whitespace from `sql`, leaving quoted
+    strings and identifiers as they are """
+    def replace(match):
+        if match.group('quoted'):
+            return match.group('quoted')
+        return ' '
+    return NORMALIZE_SQL.sub(replace, sql).strip().rstrip(';').strip()
+
+def result_size(result):
+    """ Rough size of a query result in bytes """
+    return len(repr(result.get('rows')))
+
+def limit_sql(sql, limit):
+    """ Push `limit` into `sql` if it is a plain SELECT without LIMIT, so
+    the database does not compute rows which are never fetched. """
+    body = select_body(sql)
+    if body is None:
+        return sql
+    return SQL_PUSH_LIMIT.format(sql=body, limit=int(limit))
+
+def count_sql(sql):
+    """ Return a query counting the rows of `sql`, or None if it is not a
+    plain SELECT """
+    body = select_body(sql)
+    if body is None:
+        return None
+    return SQL_COUNT.format(sql=body)
+
 def build_conn_id(conn_str):
     return md5(conn_str).hexdigest()
 
 class DBMeta(object):
-    _instances = {}
+    _multi_pool = None
+    _multi_pool_lock = Lock()
 
-    def __init__(self, conn_str, search_path=None):
+    def __init__(self, conn_str, search_path=None,
+                 stats_cache_ttl=STATS_CACHE_TTL,
+                 stats_cache_size=STATS_CACHE_SIZE,
+                 snapshot_dir=SNAPSHOT_DIR,
+                 metadata_fetcher=None,
+                 max_concurrency=MAX_CONCURRENCY,
+                 pool_size=None, max_overflow=None, pool_recycle=None,
+                 pool_pre_ping=True,
+                 result_cache_ttl=RESULT_CACHE_TTL,
+                 result_cache_size=RESULT_CACHE_SIZE,
+                 statement_timeout=None, max_cost=None, max_rows=None):
         self.conn_str = conn_str
         self.search_path = search_path or ['public']
         self.conn_id = build_conn_id(conn_str)
+        # only options which are set, other pools do not accept all of them
+        self.pool_options = {
+            key: int(value) for key, value in [
+                ('pool_size', pool_size),
+                ('max_overflow', max_overflow),
+                ('pool_recycle', pool_recycle)]
+            if value is not None}
+        self.pool_options['pool_pre_ping'] = bool(pool_pre_ping)
+        # guardrails, the timeout is in milliseconds
+        self.statement_timeout = statement_timeout and int(statement_timeout)
+        self.max_cost = None if max_cost is None else float(max_cost)
+        self.max_rows = None if max_rows is None else int(max_rows)
         self.conn = self.connect()
-        self._meta_lock = Lock()
+        self.fetcher = get_fetcher(self.conn, metadata_fetcher)
+        self._meta_lock = RLock()
         self._meta = None
         self._tables = None
+        # marker of each loaded schema at the time it was loaded
+        self._schemas = {}
+        self._completion = CompletionIndex(self.search_path)
+        self._cursor_lock = Lock()
+        self._cursors = {}
+        self._reaper = None
+        self._stats_cache = LRUCache(
+            int(stats_cache_size),
+            None if stats_cache_ttl is None else float(stats_cache_ttl))
+        self._result_cache = LRUCache(ttl=float(result_cache_ttl),
+                                      max_size=int(result_cache_size))
+        # connection pinned to hold temporary tables of materialized queries
+        self._session_lock = RLock()
+        self._session_conn = None
+        self._materialized = {}
+        self._query_slots = BoundedSemaphore(int(max_concurrency))
+        # requests and jobs using the instance, it is not evicted meanwhile
+        self._refs = 0
+        self._refs_lock = Lock()
+        self.last_used = time.time()
+        self.snapshot_dir = snapshot_dir
 
     def connect(self):
-        conn = create_engine(self.conn_str)
-        conn.execute("set search_path to {};".format(
-            ','.join(self.search_path))
-        )
+        conn = create_engine(self.conn_str, **self.pool_options)
+        event.listen(conn, 'do_connect', self._do_connect)
+        event.listen(conn, 'connect', self._on_connect)
         return conn
 
+    def _do_connect(self, dialect, conn_record, cargs, cparams):
+        """ Open a database connection, retrying with backoff while the
+        database is unreachable, e.g. during a failover. Every connection of
+        the pool is opened here, whether the engine or a checkout needs it.
+        """
+        for attempt in xrange(RECONNECT_RETRIES):
+            try:
+                return dialect.connect(*cargs, **cparams)
+            except dialect.dbapi.OperationalError:
+                if attempt == RECONNECT_RETRIES - 1:
+                    raise
+                time.sleep(RECONNECT_BACKOFF * 2 ** attempt)
+
+    def _on_connect(self, dbapi_conn, conn_record):
+        # runs for every new connection of the pool
+        cursor = dbapi_conn.cursor()
+        cursor.execute("set search_path to {};".format(
+            ','.join(self.search_path)))
+        if self.statement_timeout:
+            cursor.execute(SQL_SET_TIMEOUT.format(self.statement_timeout))
+        cursor.close()
+        # the pool rolls back on checkin, keep the settings
+        dbapi_conn.commit()
+
+    def _checkout(self):
+        """ Check out a pooled connection. Stale connections are replaced
+        thanks to pre-ping, and new ones opened by `_do_connect`. """
+        return self.conn.connect()
+
+    def reconnect(self):
+        """ Drop all pooled connections and connect again. Streaming
+        results and materialized query results are lost. """
+        self._close_connections()
+        self._checkout().close()
+
+    def close(self):
+        """ Close all connections of the pool """
+        self._close_connections()
+
+    def acquire(self):
+        with self._refs_lock:
+            self._refs += 1
+            self.last_used = time.time()
+
+    def release(self):
+        with self._refs_lock:
+            self._refs -= 1
+            self.last_used = time.time()
+
+    @property
+    def idle(self):
+        """ Whether no request, job, streaming result or materialized
+        result uses the connection """
+        return self._refs == 0 and not self._cursors \
+            and not self._materialized
+
+    @property
+    def capacity(self):
+        """ Most connections the pool may open """
+        return self.pool_options.get('pool_size', DEFAULT_POOL_SIZE) + \
+            self.pool_options.get('max_overflow', DEFAULT_MAX_OVERFLOW)
+
+    def pool_status(self):
+        pool = self.conn.pool
+        status = {
+            'conn_id': self.conn_id,
+            'pool': type(pool).__name__,
+            'capacity': self.capacity,
+            'refs': self._refs,
+            'cursors': len(self._cursors),
+            'materialized': len(self._materialized),
+            'idle_seconds': time.time() - self.last_used,
+            }
+        # only QueuePool reports its usage
+        for key in ('size', 'checkedin', 'checkedout', 'overflow'):
+            if hasattr(pool, key):
+                status[key] = getattr(pool, key)()
+        return status
+
+    def _close_connections(self):
+        with self._cursor_lock:
+            handles = list(self._cursors)
+        for handle in handles:
+            try:
+                self.close_cursor(handle)
+            except Exception:
+                traceback.print_exc()
+        with self._session_lock:
+            if self._session_conn is not None:
+                self._session_conn.close()
+            self._session_conn = None
+            self._materialized = {}
+        self.conn.dispose()
+
     def fetch_metadata(self):
+        """ Load metadata of the schemas in search path. Other schemas are
+        loaded when they are first used.
+
+        If a snapshot was saved on disk by a previous run, it is used right
+        away and revalidated against the catalog in the background.
+        """
         with self._meta_lock:
-            if self._meta:
+            if self._meta is not None:
+                return
+            snapshot = None
+            if self.snapshot_dir:
+                snapshot = load_snapshot(self.snapshot_dir, self.conn_id)
+            if snapshot is None:
+                self.load_schemas(self.search_path)
                 return
-            meta_data = self.conn.execute(SQL_FETCH_METADATA)
-            self._meta = {}
-            for r in meta_data:
-                table_name = "{}.{}".format(r['table_schema'], r['table_name'])
-                table = self._meta.setdefault(table_name, {'fields': []})
-                table['fields'].append(
-                    {'field': r['column_name'], 'type': r['data_type']}
-                )
-            self._tables = self._meta.keys()
-            self._tables.sort()
+            self._schemas = snapshot['markers']
+            self._set_meta(snapshot['meta'])
+            self._completion.update(self._meta)
+            self.load_schemas(
+                [s for s in self.search_path if s not in self._schemas])
+        revalidate = Thread(target=self._revalidate_snapshot)
+        revalidate.daemon = True
+        revalidate.start()
+
+    def load_schemas(self, schemas):
+        """ (Re)load metadata of `schemas`. Markers are fetched before the
+        metadata, so that a change happening meanwhile is seen by the next
+        refresh. """
+        schemas = list(schemas)
+        if not schemas:
+            return
+        markers = self.fetcher.fetch_markers(schemas)
+        meta = self.fetcher.fetch(schemas=schemas)
+        self._merge_meta(meta, markers)
+
+    def _merge_meta(self, meta, markers, tables=None):
+        """ Replace metadata of the schemas in `markers` (or only of
+        `tables` if given) with `meta`. Readers keep using the previous
+        dict until the new one is swapped in. """
+        with self._meta_lock:
+            if tables is None:
+                replaced = lambda name: name.split('.', 1)[0] in markers
+            else:
+                replaced = lambda name: name in tables
+            new_meta = {name: table for name, table in
+                        (self._meta or {}).items() if not replaced(name)}
+            new_meta.update(meta)
+            schemas = dict(self._schemas)
+            schemas.update(markers)
+            self._schemas = schemas
+            self._set_meta(new_meta)
+            self._completion.update(
+                new_meta, schemas=markers.keys(), tables=tables)
+            if self.snapshot_dir:
+                save_snapshot(self.snapshot_dir, self.conn_id,
+                              self._schemas, new_meta)
+        self._stats_cache.invalidate(
+            lambda key: replaced(key[1]))
+
+    def _set_meta(self, meta):
+        tables = meta.keys()
+        tables.sort()
+        self._meta, self._tables = meta, tables
 
     @require_metadata
-    def list_tables(self):
-        return self._tables
+    def refresh_metadata(self, schemas=None, tables=None):
+        """ Reload metadata which changed since it was loaded.
+
+        `tables` are reloaded unconditionally. Otherwise, the markers of
+        `schemas` (all loaded schemas by default) are compared with the
+        catalog and only the schemas which changed are reloaded.
+        """
+        if tables:
+            tables = [self._qualify_table(t) for t in tables]
+            meta = self.fetcher.fetch(tables=tables)
+            self._merge_meta(meta, {}, tables=set(tables))
+            return {'schemas': [], 'tables': tables}
+
+        schemas = list(schemas or self._schemas.keys())
+        markers = self.fetcher.fetch_markers(schemas)
+        changed = [s for s in schemas if s not in self._schemas
+                   or markers[s] != self._schemas[s]]
+        self.load_schemas(changed)
+        return {'schemas': changed, 'tables': []}
+
+    def _revalidate_snapshot(self):
+        try:
+            self.refresh_metadata()
+        except Exception:
+            traceback.print_exc()
+
+    @require_metadata
+    def list_tables(self, schema=None):
+        if schema is None:
+            return self._tables
+        if schema not in self._schemas:
+            self.load_schemas([schema])
+        prefix = schema + '.'
+        return [t for t in self._tables if t.startswith(prefix)]
+
+    def _qualify_table(self, name):
+        """ Like `_find_table`, but names of unknown tables are qualified
+        with the first schema of search path. """
+        if '.' in name:
+            return name
+        try:
+            return self._find_table(name)
+        except errors.TableNotFound:
+            return '{}.{}'.format(self.search_path[0], name)
 
     def _find_table(self, name):
         if '.' in name:
             candidates = [name]
+            schema = name.split('.', 1)[0]
+            if schema not in self._schemas:
+                self.load_schemas([schema])
         else:
             candidates = ['{}.{}'.format(s, name) for s in self.search_path]
 
@@ -100,51 +740,486 @@ class DBMeta(object):
                 return cname
         raise errors.TableNotFound(name)
 
+    @require_metadata
+    def complete(self, prefix, context='table', table=None, limit=50):
+        """ Return tables, or columns of `table`, whose name starts with
+        `prefix`, best matches first """
+        limit = int(limit)
+        if context == 'table':
+            return self._completion.tables(prefix, limit)
+        if context == 'column':
+            if not table:
+                raise ValueError('Column completion requires a table')
+            return self._completion.columns(
+                self._find_table(table), prefix, limit)
+        raise ValueError('Invalid completion context: {}'.format(context))
+
     @require_metadata
     def describe_table(self, name):
         name = self._find_table(name)
         return self._meta[name]['fields']
 
-    @require_metadata
-    def describe_field(self, table_name, field_name):
-        table_name = self._find_table(table_name)
+    def _find_field(self, table_name, field_name):
         field = [f for f in self._meta[table_name]['fields']
                  if f['field'] == field_name]
         if not field:
             raise errors.FieldNotFound(table_name, field_name)
+        return field[0]
+
+    @require_metadata
+    def describe_field(self, table_name, field_name, sample=None,
+                       sample_method='system', mode='scan'):
+        """ Return distinct count, most common values and, for numeric
+        fields, min/max/avg of a field.
+
+        If `sample` is given, stats are computed from a sample of the table
+        instead of a full scan, either a percentage ('10%') or a number of
+        rows ('10000'). Counts are then scaled up to the whole table, with
+        95% confidence bounds, and the result is flagged as approximate.
+
+        With `mode='catalog'`, stats are read from the planner statistics
+        (`pg_stats`) without touching the table. The table is only scanned
+        when these statistics are missing or stale. `source` in the result
+        tells whether stats come from the 'catalog', a 'scan' or a 'sample'.
+        """
+        if mode not in DESCRIBE_MODES:
+            raise ValueError('Invalid describe mode: {}'.format(mode))
+        table_name = self._find_table(table_name)
+        key = (self.conn_id, table_name, field_name, mode, sample,
+               sample_method)
+        result = self._stats_cache.get(key)
+        if result is None:
+            result = self._describe_field(
+                table_name, field_name, sample, sample_method, mode)
+            self._stats_cache.set(key, result)
+        return deepcopy(result)
 
-        field = field[0]
+    def _describe_field(self, table_name, field_name, sample, sample_method,
+                        mode):
+        field = self._find_field(table_name, field_name)
         # is it categorical field?
         limit = 20
-        sql_ctx = {
-            'table_name': table_name,
-            'field_name': field_name,
-            'limit': limit
+        numeric = is_numeric(field)
+        if mode == 'catalog':
+            result = self._catalog_stats(table_name, field, limit)
+            if result is not None:
+                return result
+
+        sampling = {'source': table_name, 'scans': 0}
+        if sample:
+            sampling = self._sample_source(table_name, sample, sample_method)
+        sql = SQL_FIELD_STATS.format(
+            source=sampling['source'],
+            field_name=field_name,
+            numeric_stats=SQL_NUMERIC_STATS if numeric else '',
+            limit=limit)
+        rows = self.conn.execute(sql).fetchall()
+        result = {
+            'distinct_count': rows[0]['distinct_count'] if rows else 0,
+            'most_common': [{'value': r['value'], 'count': r['cnt']}
+                            for r in rows],
+            'scans': sampling['scans'] + 1,
+            'source': 'sample' if sample else 'scan'
             }
-        distinct_count = self.conn.execute(
-            SQL_COUNT_DISTINCT.format(**sql_ctx)
-        ).first()[0]
-        most_common = self.conn.execute(SQL_MOST_COMMON.format(**sql_ctx))
-        most_common = [{'value': r[field_name], 'count': r['cnt']}
-                       for r in most_common]
+        if sample:
+            self._scale_sampled_stats(result, rows, sampling)
+
+        if result['distinct_count'] > limit and numeric:
+            result.update({
+                'min': rows[0]['min'],
+                'max': rows[0]['max'],
+                'avg': rows[0]['avg'],
+                })
+        return result
+
+    def invalidate(self, table_name=None, field_name=None):
+        """ Drop cached stats of a field, of all fields of a table, or
+        everything. Returns the number of dropped entries. """
+        if table_name:
+            table_name = self._find_table(table_name)
+        return self._stats_cache.invalidate(
+            lambda key: table_name in (None, key[1])
+            and field_name in (None, key[2]))
+
+    def invalidate_results(self):
+        """ Drop all cached query results """
+        return self._result_cache.invalidate()
+
+    def cache_stats(self):
+        return {
+            'stats': self._stats_cache.stats(),
+            'results': self._result_cache.stats()
+            }
+
+    def _catalog_stats(self, table_name, field, limit):
+        """ Build field stats from `pg_stats`. Returns None when the stats
+        are not available or stale. """
+        if self.conn.dialect.name != 'postgresql':
+            return None
+        schema_name, name = table_name.split('.', 1)
+        stats = self.conn.execute(
+            SQL_CATALOG_STATS,
+            schema_name=schema_name,
+            table_name=name,
+            field_name=field['field']).first()
+        if stats is None or stats['row_count'] <= 0:
+            return None
+        row_count = stats['row_count']
+        if stats['n_mod_since_analyze'] > CATALOG_STALE_RATIO * row_count:
+            return None
+
+        numeric = is_numeric(field)
+        n_distinct = stats['n_distinct']
+        if n_distinct < 0:
+            # negative values are a fraction of the number of rows
+            n_distinct = -n_distinct * row_count
+        values = [parse_value(v, numeric)
+                  for v in stats['most_common_vals'] or []]
+        freqs = stats['most_common_freqs'] or []
         result = {
-            'distinct_count': distinct_count,
-            'most_common': most_common
+            'distinct_count': int(round(n_distinct)),
+            'most_common': [{'value': v, 'count': int(round(f * row_count))}
+                            for v, f in zip(values, freqs)][:limit],
+            'row_count': row_count,
+            'approximate': True,
+            'scans': 0,
+            'source': 'catalog'
             }
 
-        if distinct_count > limit and is_numeric(field):
-            stats = self.conn.execute(
-                SQL_NUMERIC_STATS.format(**sql_ctx)
-            ).first()
+        bounds = [parse_value(v, numeric)
+                  for v in stats['histogram_bounds'] or []]
+        if result['distinct_count'] > limit and numeric and values + bounds:
+            # histogram bounds exclude the most common values
             result.update({
-                'min': stats['min'],
-                'max': stats['max'],
-                'avg': stats['avg'],
+                'min': min(values + bounds),
+                'max': max(values + bounds),
                 })
         return result
 
-    def run_sql(self, sql, limit=100):
-        rs = self.conn.execute(sql)
+    def _sample_source(self, table_name, sample, method):
+        """ Return how to sample `table_name`: the FROM clause `source`,
+        either the sampled `percent` or the `total` number of rows of the
+        table, and the number of `scans` spent to count them.
+        """
+        kind, size = parse_sample(sample)
+        if method not in TABLESAMPLE_METHODS:
+            raise ValueError('Invalid sample method: {}'.format(method))
+        if self.conn.dialect.name in TABLESAMPLE_DIALECTS:
+            if kind == 'percent':
+                return {
+                    'source': SQL_TABLESAMPLE.format(
+                        table_name=table_name, method=method, percent=size),
+                    'percent': size,
+                    'scans': 0
+                    }
+            # a random sample of about `size` rows, LIMIT takes the first
+            # rows of the table
+            total, scans = self._estimate_row_count(table_name)
+            percent = min(100.0, 100.0 * size / total) if total else 100.0
+            return {
+                'source': SQL_TABLESAMPLE.format(
+                    table_name=table_name, method=method, percent=percent),
+                'total': total,
+                'scans': scans
+                }
+
+        total, scans = self._estimate_row_count(table_name)
+        rows = size if kind == 'rows' else int(math.ceil(total * size / 100))
+        return {
+            'source': SQL_LIMIT_SAMPLE.format(table_name=table_name, rows=rows),
+            'total': total,
+            'scans': scans
+            }
+
+    def _estimate_row_count(self, table_name):
+        """ Return the number of rows of a table and the number of scans
+        spent on it. Planner statistics are used when they exist. """
+        if self.conn.dialect.name == 'postgresql':
+            estimate = self.conn.execute(
+                SQL_ESTIMATE_ROWS, table_name=table_name).scalar()
+            if estimate > 0:
+                return estimate, 0
+        count = self.conn.execute(
+            SQL_COUNT_ROWS.format(table_name=table_name)).scalar()
+        return count, 1
+
+    def _scale_sampled_stats(self, result, rows, sampling):
+        result['approximate'] = True
+        sample_rows = int(rows[0]['row_count']) if rows else 0
+        result['sample_rows'] = sample_rows
+        if not sample_rows:
+            return
+        if 'percent' in sampling:
+            total = int(round(sample_rows * 100 / sampling['percent']))
+        else:
+            total = max(sampling['total'], sample_rows)
+        scale = float(total) / sample_rows
+
+        # Guaranteed-error estimator: values seen once in the sample stand
+        # for sqrt(scale) values of the table, the others are all seen.
+        distinct, singletons = rows[0]['distinct_count'], rows[0]['singletons']
+        result['distinct_count'] = int(round(
+            math.sqrt(scale) * singletons + distinct - singletons))
+        result['distinct_count_low'] = distinct
+        result['distinct_count_high'] = int(round(
+            distinct + singletons * (scale - 1)))
+
+        for item in result['most_common']:
+            item['count'], item['count_low'], item['count_high'] = \
+                count_bounds(item['count'], sample_rows, total)
+        result['row_count'] = total
+
+    @contextmanager
+    def connection(self, session=False):
+        """ Yield a connection from the pool, or the session connection
+        holding materialized query results if `session` is True. The session
+        connection is used by one caller at a time. """
+        if not session:
+            conn = self._checkout()
+            try:
+                yield conn
+            finally:
+                conn.close()
+            return
+        with self._session_lock:
+            if self._session_conn is None or self._session_conn.closed \
+                    or self._session_conn.invalidated:
+                if self._session_conn is not None:
+                    self._session_conn.close()
+                self._session_conn = self._checkout()
+                self._materialized = {}
+            yield self._session_conn
+
+    def materialize(self, name, sql, ttl=None, timeout=None, confirm=False):
+        """ Run `sql` into a temporary table of the session connection and
+        return the name of the table. The table is reused until `ttl`
+        seconds passed or `sql` changed. `timeout` and `confirm` work as in
+        `run_sql`. """
+        ttl = MATERIALIZE_TTL if ttl is None else ttl
+        query_hash = sql_hash(sql)[:12]
+        with self.connection(session=True) as conn:
+            entry = self._materialized.get(name)
+            if entry and entry['hash'] == query_hash \
+                    and time.time() - entry['created'] < ttl:
+                return entry['table_name']
+            if entry:
+                conn.execute(SQL_DROP_TABLE.format(**entry))
+                del self._materialized[name]
+            if not confirm:
+                self._check_cost(sql, conn)
+            table_name = 'yamlsql_{}_{}'.format(
+                re.sub(r'\W', '_', name), query_hash)
+            with self._timeout(conn, timeout) as timeout_conn:
+                timeout_conn.execute(SQL_MATERIALIZE.format(
+                    table_name=table_name, sql=sql.strip().rstrip(';')))
+            self._materialized[name] = {
+                'table_name': table_name,
+                'hash': query_hash,
+                'created': time.time(),
+                'ttl': ttl
+                }
+            return table_name
+
+    def drop_materialized(self, name=None):
+        """ Drop materialized results of query `name`, or of all queries.
+        Returns the number of dropped results. """
+        with self.connection(session=True) as conn:
+            names = [n for n in self._materialized if name in (None, n)]
+            for n in names:
+                conn.execute(SQL_DROP_TABLE.format(
+                    **self._materialized.pop(n)))
+        return len(names)
+
+    def drop_expired_materialized(self):
+        """ Drop materialized results past their TTL, unless the session
+        connection is in use. Returns the number of dropped results. """
+        if not self._materialized or not self._session_lock.acquire(False):
+            return 0
+        try:
+            conn = self._session_conn
+            if conn is None or conn.closed or conn.invalidated:
+                # the temporary tables went away with the connection, do
+                # not reconnect only to find that out
+                dropped = len(self._materialized)
+                self._materialized = {}
+                return dropped
+            now = time.time()
+            expired = [name for name, entry in self._materialized.items()
+                       if now - entry['created'] >= entry['ttl']]
+            for name in expired:
+                self.drop_materialized(name)
+            return len(expired)
+        except Exception:
+            traceback.print_exc()
+            return 0
+        finally:
+            self._session_lock.release()
+
+    def run_sql(self, sql, limit=100, stream=False, conn=None,
+                session=False, push_limit=False, count=False, cache=False,
+                timeout=None, confirm=False):
+        """ Execute `sql` and return the first `limit` rows.
+
+        If `stream` is True, the query runs on a server-side cursor which
+        stays open after the first batch. The result then contains a
+        `handle` that can be passed to `fetch_more` to get the next rows.
+        If `conn` is given, the query is executed on that connection
+        instead of the engine. If `session` is True, it is executed on the
+        session connection, where materialized results can be read.
+
+        If `push_limit` is True, a plain SELECT without LIMIT only computes
+        `limit` rows, and `rowcount` is at most `limit`. If `count` is True,
+        the total number of rows is returned as `total_count`.
+
+        If `cache` is True, the result of a query run recently with the same
+        options is returned with `cached` set and its `cache_age` in
+        seconds. Any statement which is not a SELECT clears cached results.
+
+        On Postgres, `timeout` overrides the statement timeout of the
+        connection, in milliseconds. Queries whose estimated cost or rows
+        exceed `max_cost` or `max_rows` of the connection raise
+        QueryTooExpensive, unless `confirm` is True. Estimates are those of
+        the statements which actually run: with `push_limit`, estimated
+        rows are at most `limit`, so `max_rows` only guards queries run
+        without it. The query counting rows for `count` is checked too.
+        """
+        def run():
+            return self._run_sql(sql, limit, stream, conn, session,
+                                 push_limit, count, timeout, confirm)
+        # only results of statements which do not change data are cached
+        if not cache or stream or not is_read_only(sql):
+            result = run()
+        else:
+            key = (normalize_sql(sql), int(limit), push_limit, count)
+            entry = self._result_cache.get(key)
+            if entry is not None:
+                result, created = entry
+                return dict(result, cached=True,
+                            cache_age=time.time() - created)
+            result = run()
+            if 'rows' in result:
+                self._result_cache.set(key, (result, time.time()),
+                                       size=result_size(result))
+        # the statement may have changed data of cached results
+        if len(self._result_cache) and not is_read_only(sql):
+            self._result_cache.invalidate()
+        return result
+
+    def _run_sql(self, sql, limit, stream, conn, session, push_limit, count,
+                 timeout, confirm):
+        if session:
+            if stream:
+                raise ValueError(
+                    'Queries reading materialized results cannot stream')
+            with self.connection(session=True) as conn:
+                return self._run_sql(sql, limit, False, conn, False,
+                                     push_limit, count, timeout, confirm)
+        counting_sql = count_sql(sql) if count else None
+        if counting_sql and not confirm:
+            # counting computes every row, even those a pushed limit skips
+            self._check_cost(counting_sql, conn, can_explain=True)
+        if stream:
+            if not confirm:
+                self._check_cost(sql, conn)
+            result = self._run_streaming(sql, limit, timeout)
+        else:
+            limited_sql = limit_sql(sql, limit) if push_limit else sql
+            if not confirm:
+                # wrapping keeps a statement explainable, skip parsing it
+                self._check_cost(limited_sql, conn,
+                                 sql_info(sql)['explainable'])
+            with self._timeout(conn, timeout) as timeout_conn:
+                result = self._execute(timeout_conn, limited_sql, limit)
+        if count:
+            with self._timeout(conn, timeout) as timeout_conn:
+                result['total_count'] = self._count_rows(sql, timeout_conn)
+        return result
+
+    @contextmanager
+    def _timeout(self, conn, timeout):
+        """ Yield a connection where statements time out after `timeout`
+        milliseconds, in a transaction. Only Postgres supports it. """
+        if conn is None:
+            with self.connection() as conn, \
+                    self._timeout(conn, timeout) as conn:
+                yield conn
+            return
+        if not timeout or self.conn.dialect.name != 'postgresql':
+            yield conn
+            return
+        with conn.begin():
+            conn.execute(SQL_SET_LOCAL_TIMEOUT.format(int(timeout)))
+            yield conn
+
+    def explain(self, sql, conn=None):
+        """ Return the estimated plan of `sql` without running it """
+        if self.conn.dialect.name != 'postgresql':
+            raise ValueError('EXPLAIN is only supported on PostgreSQL')
+        plan = (conn or self.conn).execute(SQL_EXPLAIN.format(
+            sql=sql.strip().rstrip(';'))).scalar()
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return plan[0]['Plan']
+
+    def _check_cost(self, sql, conn=None, can_explain=None):
+        """ Raise QueryTooExpensive if the estimated cost or rows of `sql`
+        exceed the thresholds of the connection """
+        if self.max_cost is None and self.max_rows is None:
+            return
+        if self.conn.dialect.name != 'postgresql':
+            return
+        if can_explain is None:
+            can_explain = explainable(sql)
+        if not can_explain:
+            return
+        plan = self.explain(sql, conn)
+        for key, name, threshold in [
+                ('Total Cost', 'cost', self.max_cost),
+                ('Plan Rows', 'rows', self.max_rows)]:
+            if threshold is not None and plan[key] > threshold:
+                raise errors.QueryTooExpensive(
+                    'Estimated {} {:.0f} exceeds max_{} {}, run it with '
+                    'confirm=1 to proceed'.format(
+                        name, plan[key], name, threshold))
+
+    def run_many(self, queries, limit=100, session=False, **options):
+        """ Run each of `queries`, a list of (name, sql), on its own pooled
+        connection, at most `max_concurrency` at a time. Returns a result
+        per query with its `name`, `elapsed` seconds and `error` if it
+        failed. `options` are passed to `run_sql`. Queries reading
+        materialized results (`session`) share a connection and run one
+        after the other. """
+        def run(query):
+            name, sql = query
+            start = time.time()
+            result = {'name': name}
+            try:
+                with self._query_slots, self.connection(session) as conn:
+                    result.update(self.run_sql(sql, limit, conn=conn,
+                                               **options))
+            except Exception, e:
+                result['error'] = e.message or str(e)
+            result['elapsed'] = time.time() - start
+            return result
+        if len(queries) < 2:
+            return [run(query) for query in queries]
+        return self._get_multi_pool().map(run, queries)
+
+    @classmethod
+    def _get_multi_pool(cls):
+        with cls._multi_pool_lock:
+            if cls._multi_pool is None:
+                cls._multi_pool = ThreadPool(MULTI_WORKERS)
+            return cls._multi_pool
+
+    def _count_rows(self, sql, conn=None):
+        counting_sql = count_sql(sql)
+        if counting_sql is None:
+            return None
+        return (conn or self.conn).execute(counting_sql).scalar()
+
+    def _execute(self, conn, sql, limit):
+        rs = conn.execute(sql)
         result = {
             "rowcount": rs.rowcount
             }
@@ -157,15 +1232,109 @@ class DBMeta(object):
             pass
         return result
 
+    def _run_streaming(self, sql, limit, timeout=None):
+        conn = self._checkout()
+        try:
+            if timeout and self.conn.dialect.name == 'postgresql':
+                # the server-side cursor keeps the transaction open, each
+                # fetch is bound by the timeout too
+                conn.execute(SQL_SET_LOCAL_TIMEOUT.format(int(timeout)))
+            rs = conn.execution_options(stream_results=True).execute(sql)
+        except Exception:
+            conn.close()
+            raise
+        if not rs.returns_rows:
+            conn.close()
+            return {"rowcount": rs.rowcount}
+
+        handle = uuid4().hex
+        with self._cursor_lock:
+            self._cursors[handle] = {
+                'conn': conn,
+                'result': rs,
+                'lock': Lock(),
+                'last_access': time.time()
+                }
+            self._start_reaper()
+        return self.fetch_more(handle, limit)
+
+    def fetch_more(self, handle, limit=100):
+        """ Fetch the next `limit` rows from a streaming result.
+        The handle is closed once the result is exhausted.
+        """
+        with self._cursor_lock:
+            cursor = self._cursors.get(handle)
+        if cursor is None:
+            raise errors.CursorNotFound(handle)
+
+        with cursor['lock']:
+            rs = cursor['result']
+            rows = rs.fetchmany(limit)
+            cursor['last_access'] = time.time()
+        has_more = len(rows) == limit
+        if not has_more:
+            self.close_cursor(handle)
+        return {
+            'handle': handle if has_more else None,
+            'has_more': has_more,
+            'columns': rs.keys(),
+            'rows': [r.values() for r in rows]
+            }
+
+    def close_cursor(self, handle):
+        with self._cursor_lock:
+            cursor = self._cursors.pop(handle, None)
+        if cursor is None:
+            return False
+        with cursor['lock']:
+            cursor['result'].close()
+            cursor['conn'].close()
+        return True
+
+    def close_idle_cursors(self, timeout=CURSOR_IDLE_TIMEOUT):
+        """ Close streaming results which have not been used for
+        `timeout` seconds. Returns the number of closed handles.
+        """
+        deadline = time.time() - timeout
+        with self._cursor_lock:
+            idle = [handle for handle, cursor in self._cursors.items()
+                    if cursor['last_access'] < deadline]
+        return len([h for h in idle if self.close_cursor(h)])
+
+    def _start_reaper(self):
+        # Caller must hold `_cursor_lock`
+        if self._reaper is not None:
+            return
+        self._reaper = Thread(target=self._reap_cursors)
+        self._reaper.daemon = True
+        self._reaper.start()
+
+    def _reap_cursors(self):
+        while True:
+            time.sleep(CURSOR_REAP_INTERVAL)
+            self.close_idle_cursors()
+            with self._cursor_lock:
+                if not self._cursors:
+                    self._reaper = None
+                    return
+
+    def backend_pid(self, conn):
+        """ Return the backend process id serving `conn`, or None if the
+        dialect does not support cancelling queries """
+        if self.conn.dialect.name != 'postgresql':
+            return None
+        return conn.execute(SQL_BACKEND_PID).scalar()
+
+    def cancel_backend(self, pid):
+        """ Ask the database to cancel the query running on backend `pid` """
+        if pid is None or self.conn.dialect.name != 'postgresql':
+            return False
+        return self.conn.execute(SQL_CANCEL_BACKEND, pid=pid).scalar()
+
     @classmethod
     def get_instance(cls, conn_id):
-        return cls._instances.get(conn_id)
+        return get_db(conn_id)
 
     @classmethod
-    def create_instance(cls, conn_str, search_path=None):
-        conn_id = build_conn_id(conn_str)
-        if conn_id in cls._instances:
-            return cls._instances[conn_id]
-        db_meta = DBMeta(conn_str, search_path)
-        cls._instances[db_meta.conn_id] = db_meta
-        return db_meta
+    def create_instance(cls, conn_str, search_path=None, **options):
+        return create_conn(conn_str, search_path, **options)
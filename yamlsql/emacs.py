@@ -27,15 +27,25 @@ def describe_field(data):
     most_common = tabulate([(x['value'], x['count']) for x in data['most_common']],
                            headers=['Value', 'Count'],
                            tablefmt='simple')
+    title = data['field_name']
+    if data.get('source') == 'catalog':
+        title += ', approximate from planner statistics'
+    elif data.get('source') == 'sample':
+        title += ', approximate from {} sampled rows'.format(
+            data.get('sample_rows', 0))
     return {
         'text': DESCRIBE_FIELD_TMPL.format(
-            data['field_name'],
+            title,
             stats,
             most_common).strip()
         }
 
 def run_sql(data):
     result = tabulate(data['rows'], headers=data['columns'], tablefmt='simple')
+    if data.get('cached'):
+        result = '[Cached results from {:.0f} seconds ago]\n\n{}'.format(
+            data['cache_age'], result)
     return {
-        'text': result
+        'text': result,
+        'handle': data.get('handle')
         }
@@ -2,4 +2,28 @@ class TableNotFound(Exception):
     pass
 
 class ViewNotFound(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class FieldNotFound(Exception):
+    pass
+
+class CursorNotFound(Exception):
+    pass
+
+class JobNotFound(Exception):
+    pass
+
+class BufferNotFound(Exception):
+    pass
+
+class BufferOutOfDate(Exception):
+    pass
+
+class ConnectionNotFound(Exception):
+    pass
+
+class ConnectionLimitReached(Exception):
+    pass
+
+class QueryTooExpensive(Exception):
+    pass
@@ -0,0 +1,150 @@
+import time
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from uuid import uuid4
+
+from . import errors
+
+MAX_WORKERS = 4
+# Seconds a finished job is kept so its result can still be fetched
+JOB_RESULT_TTL = 3600
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class Job(object):
+    """ Query run on the worker pool. `sql` may be a function returning the
+    SQL and whether it runs on the session connection, called by the
+    worker, e.g. to materialize the queries it references first. """
+    def __init__(self, db, sql, limit, session=False, **options):
+        self.job_id = uuid4().hex
+        self.db = db
+        self.sql = sql
+        self.limit = limit
+        self.session = session
+        # extra options of `DBMeta.run_sql`
+        self.options = options
+        self.status = PENDING
+        self.result = None
+        self.error = None
+        self.backend_pid = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = Lock()
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    def run(self):
+        try:
+            self._run()
+        finally:
+            # acquired by JobManager.submit
+            self.db.release()
+
+    def _run(self):
+        with self._lock:
+            if self.status == CANCELLED:
+                return
+            self.status = RUNNING
+            self.started_at = time.time()
+        try:
+            if callable(self.sql):
+                self.sql, self.session = self.sql()
+            with self.db.connection(self.session) as conn:
+                backend_pid = self.db.backend_pid(conn)
+                with self._lock:
+                    self.backend_pid = backend_pid
+                    cancelled = self.status == CANCELLED
+                try:
+                    if not cancelled:
+                        result = self.db.run_sql(
+                            self.sql, self.limit, conn=conn, **self.options)
+                finally:
+                    # before the connection goes back to the pool, where a
+                    # cancel would hit the next query using it
+                    with self._lock:
+                        self.backend_pid = None
+            with self._lock:
+                if self.status != CANCELLED:
+                    self.result = result
+                    self.status = DONE
+        except Exception, e:
+            with self._lock:
+                if self.status != CANCELLED:
+                    self.error = e.message or str(e)
+                    self.status = FAILED
+        finally:
+            self.finished_at = time.time()
+
+    def cancel(self):
+        """ Cancel the job. A queued job is dropped before it starts, a
+        running one is cancelled on the database backend. """
+        with self._lock:
+            if self.finished:
+                return False
+            running = self.status == RUNNING
+            self.status = CANCELLED
+            if not running:
+                self.finished_at = time.time()
+            else:
+                # holding the lock keeps the backend running this job
+                self.db.cancel_backend(self.backend_pid)
+        return True
+
+    def to_dict(self):
+        end = self.finished_at or time.time()
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'error': self.error,
+            'elapsed': end - (self.started_at or end),
+            }
+
+
+class JobManager(object):
+    def __init__(self, max_workers=MAX_WORKERS, result_ttl=JOB_RESULT_TTL):
+        self.max_workers = max_workers
+        self.result_ttl = result_ttl
+        self._pool = None
+        self._lock = Lock()
+        self._jobs = {}
+
+    def submit(self, db, sql, limit=100, session=False, **options):
+        """ Queue `sql` for execution on the worker pool """
+        job = Job(db, sql, limit, session, **options)
+        # keep the connection from being evicted until the job ran
+        db.acquire()
+        with self._lock:
+            self._purge()
+            if self._pool is None:
+                self._pool = ThreadPool(self.max_workers)
+            self._jobs[job.job_id] = job
+        self._pool.apply_async(job.run)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise errors.JobNotFound(job_id)
+        return job
+
+    def cancel(self, job_id):
+        return self.get(job_id).cancel()
+
+    def _purge(self):
+        deadline = time.time() - self.result_ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and job.finished_at < deadline]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+JOBS = JobManager()
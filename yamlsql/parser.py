@@ -1,12 +1,50 @@
+import re
+from bisect import bisect_right
+
 from ruamel.yaml import YAML
 from ruamel.yaml.comments import CommentedMap, CommentedSeq
 from funcy import print_calls
 
 
+TOP_LEVEL_ITEM = re.compile(r'^-(\s|$)')
+# Anchors, aliases, tags and multiple documents may tie top-level items to
+# each other, so documents using them are not split.
+UNSPLITTABLE = re.compile(r'(^|[\s\[{,])[&*!][\w!]|^(---|\.\.\.|%)', re.M)
+
+
+def split_items(content):
+    """ Split the source of a YAML sequence into its top-level items, without
+    parsing it. Return a list of (lineno, source) where `lineno` is the first
+    line of the item, starting with 1.
+
+    Return None if the document cannot be split safely, e.g. it is not a
+    block sequence, or uses anchors, aliases or tags.
+    """
+    if UNSPLITTABLE.search(content):
+        return None
+    items = []
+    for i, line in enumerate(content.splitlines(True)):
+        if TOP_LEVEL_ITEM.match(line):
+            items.append((i + 1, [line]))
+        elif not line.strip() or line.lstrip().startswith('#'):
+            if items:
+                items[-1][1].append(line)
+        elif line.startswith(' ') and items:
+            items[-1][1].append(line)
+        else:
+            return None
+    if not items:
+        return None
+    return [(lineno, ''.join(lines)) for lineno, lines in items]
+
+
 class YAMLParser(object):
     def __init__(self, content):
         yaml = YAML()
         self._doc = yaml.load(content)
+        self._line_count = len(content.splitlines())
+        # first lines and keys of the children of each container, by id
+        self._index = {}
 
     @property
     def doc(self):
@@ -38,21 +76,55 @@ class YAMLParser(object):
         """
         return self._find_path(self._doc, lineno - 1, level)
 
+    def _line_index(self, node):
+        """ Return the sorted first lines of the children of a container,
+        and their keys. The index is built once per container. """
+        index = self._index.get(id(node))
+        if index is None:
+            items = sorted(((v[0], k) for k, v in node.lc.data.items()),
+                           key=lambda x: x[0])
+            index = ([line for line, _ in items], [key for _, key in items])
+            self._index[id(node)] = index
+        return index
+
     def _find_path(self, root, lineno, level=None):
         if level == 0 or not isinstance(root, (CommentedMap, CommentedSeq)):
             return []
-        items = [{'key': k, 'lineno': v[0]} for k, v in root.lc.data.items()]
-        items.sort(key=lambda x: x['lineno'])
-        key = None
-        for i, item in enumerate(items):
-            if item['lineno'] > lineno:
-                key = items[i-1]['key']
-                break
-        if key is None:
-            key = items[-1]['key']
+        starts, keys = self._line_index(root)
+        if not keys:
+            return []
+        # The child is the last one starting before or at the line. Lines
+        # before the first child wrap around to the last one.
+        key = keys[bisect_right(starts, lineno) - 1]
         level = None if level is None else level - 1
         return [key] + self._find_path(root[key], lineno, level)
 
+    def line_paths(self):
+        """ Return the path of every line of the document, the n-th path
+        being the one `find_path` returns for line n + 1. """
+        paths = [None] * self._line_count
+        self._map_lines(self._doc, 0, self._line_count, [], paths)
+        return paths
+
+    def _map_lines(self, node, start, end, path, paths):
+        """ Set the path of lines from `start` to `end` (excluded), which
+        all lie in `node` """
+        keys = None
+        if isinstance(node, (CommentedMap, CommentedSeq)):
+            starts, keys = self._line_index(node)
+        if not keys:
+            for lineno in xrange(start, end):
+                paths[lineno] = list(path)
+            return
+        ends = starts[1:] + [end]
+        segments = [(start, min(starts[0], end), len(keys) - 1)]
+        segments += [(max(starts[i], start), min(ends[i], end), i)
+                     for i in xrange(len(keys))]
+        for lo, hi, i in segments:
+            if lo < hi:
+                key = keys[i]
+                self._map_lines(node[key], lo, hi, path + [key], paths)
+
     def find_obj_from_path(self, path):
         """ Return the object from a index/key path. """
         item = self._doc
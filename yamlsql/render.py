@@ -1,15 +1,73 @@
+import re
+from hashlib import md5
+from textwrap import dedent
+
 import sqlparse
 from funcy import omit, merge
 from ruamel.yaml.comments import CommentedMap
 
-from .parser import YAMLParser
+from .cache import LRUCache
+from .parser import YAMLParser, split_items
+
+# Parsed documents and rendered queries of recently rendered contents,
+# bounded by the number of documents and their total source size.
+RENDER_CACHE_SIZE = 100
+RENDER_CACHE_MAX_BYTES = 20 * 1024 * 1024
+RENDER_CACHE = LRUCache(RENDER_CACHE_SIZE, max_size=RENDER_CACHE_MAX_BYTES)
+
+# Renders of single items of documents, kept apart so that rendering the
+# items of a large document does not evict the documents themselves.
+ITEM_CACHE_SIZE = 10000
+ITEM_CACHE = LRUCache(ITEM_CACHE_SIZE, max_size=RENDER_CACHE_MAX_BYTES)
+
+
+# 'pretty' reindents SQL and upper-cases keywords, 'fast' only drops blank
+# lines and trailing spaces, 'none' leaves SQL as it is for execution.
+FORMAT_MODES = ('pretty', 'fast', 'none')
+FORMAT_CACHE_SIZE = 1000
+FORMAT_CACHE = LRUCache(FORMAT_CACHE_SIZE)
+
 
+def sql_format(sql, mode='pretty'):
+    if mode not in FORMAT_MODES:
+        raise ValueError('Invalid format mode: {}'.format(mode))
+    key = (mode, sql)
+    formatted = FORMAT_CACHE.get(key)
+    if formatted is None:
+        formatted = _sql_format(sql, mode)
+        FORMAT_CACHE.set(key, formatted)
+    return formatted
 
-def sql_format(sql):
+
+def _sql_format(sql, mode):
     sql = sql.strip()
     if not sql.endswith(';'):
         sql = sql + ';'
-    return sqlparse.format(sql.strip(), reindent=True, keyword_case='upper')
+    if mode == 'pretty':
+        return sqlparse.format(sql, reindent=True, keyword_case='upper')
+    if mode == 'fast':
+        # the first line was stripped, dedent the following ones on their own
+        first, _, rest = sql.partition('\n')
+        lines = [first] + dedent(rest).splitlines()
+        return '\n'.join(line.rstrip() for line in lines if line.strip())
+    return sql
+
+
+WITH_CLAUSE = re.compile(r'^\s*with\s', re.I)
+
+
+def _refs(item):
+    """ Names of the queries an item references in its `with` key """
+    refs = item.get('with') if isinstance(item, dict) else None
+    if not refs:
+        return []
+    if isinstance(refs, basestring):
+        return [refs]
+    return list(refs)
+
+
+def _body(sql):
+    return sql.strip().rstrip(';').rstrip()
 
 
 def _build_clause(name, item):
@@ -41,7 +99,7 @@ class SqlProcessor(Processor):
     when = 'sql'
 
     def transform(self, item):
-        return sql_format(item['sql'])
+        return item['sql']
 
 
 class SelectProcessor(Processor):
@@ -68,40 +126,283 @@ class SelectProcessor(Processor):
             {'sql': sql})
 
 
+def compile_processors(processors):
+    """ Return a table mapping each trigger key to the indexes of the
+    processors it triggers, and the indexes of processors without trigger,
+    which are tried on every item. """
+    dispatch, generic = {}, []
+    for index, p in enumerate(processors):
+        if p.when:
+            dispatch.setdefault(p.when, []).append(index)
+        else:
+            generic.append(index)
+    return dispatch, generic
+
+
 class SQLRender(object):
     MAX_ITERATION = 100
     DEFAULT_PROCESSORS = [SqlProcessor, SelectProcessor]
 
-    def __init__(self, content, processors=DEFAULT_PROCESSORS):
-        self.parser = YAMLParser(content)
+    def __init__(self, content, processors=DEFAULT_PROCESSORS,
+                 format_mode='pretty'):
+        if format_mode not in FORMAT_MODES:
+            raise ValueError('Invalid format mode: {}'.format(format_mode))
+        self.content = content
+        self.format_mode = format_mode
         if not processors:
             processors = self.DEFAULT_PROCESSORS
+        self.processor_classes = tuple(processors)
         self.processors = [cls() for cls in processors]
+        self._dispatch, self._generic = compile_processors(self.processors)
+        self._parser = None
+        self._items = None
+        self._rendered = {}
+        self._names = None
+        self._bodies = {}
+
+    @property
+    def parser(self):
+        """ Parser of the whole document, created on first use """
+        if self._parser is None:
+            self._parser = YAMLParser(self.content)
+        return self._parser
+
+    @property
+    def items(self):
+        """ Source of the top-level items, see `split_items` """
+        if self._items is None:
+            self._items = split_items(self.content) or []
+        return self._items
 
-    def render(self, query_name=None, lineno=None):
+    def render(self, query_name=None, lineno=None, overrides=None):
         """ Render YAML to SQL
         If `query_name` is specified, only render query with specified name
         If `lineno` is specified, only render query around specified line
+        If `overrides` is specified, referenced queries named in it are
+        replaced by the given SQL, see `render_item`.
+
+        When the document can be split into top-level items without parsing
+        it, only the items to render are parsed, unless they reference other
+        queries.
         """
+        if overrides:
+            return '\n\n'.join(
+                self.render_item(item, overrides)
+                for item in self._target_items(query_name, lineno))
+
+        sqls = None
+        if query_name and self.items and self._parser is None:
+            sqls = [self._render_source(source, query_name)
+                    for _, source in self.items if query_name in source]
+        elif not query_name and not lineno and self.items \
+                and self._parser is None:
+            # items which did not change since a previous render of the
+            # same buffer are taken from the cache
+            sqls = [self._render_source(source) for _, source in self.items]
+        elif lineno and self.items and self.items[0][0] <= lineno:
+            source = [src for start, src in self.items if start <= lineno][-1]
+            sqls = [self._render_source(source)]
+        if sqls is not None and None not in sqls:
+            return '\n\n'.join(sql for sql in sqls if sql)
+
+        doc = self.parser.doc
         if query_name:
-            items = [item for item in self.parser.doc
-                     if item.get('name') == query_name]
-            return '\n\n'.join(self.render_item(item) for item in items)
+            indexes = [i for i, item in enumerate(doc)
+                       if item.get('name') == query_name]
+            return '\n\n'.join(self._render_index(i) for i in indexes)
 
         if lineno:
-            return self.render_item(self.parser.find_root(lineno))
+            return self._render_index(
+                self.parser.find_path(lineno, level=1)[0])
 
-        return '\n\n'.join(self.render_item(item) for item in self.parser.doc)
+        return '\n\n'.join(self._render_index(i) for i in xrange(len(doc)))
 
-    def render_item(self, item):
+    def _target_items(self, query_name=None, lineno=None):
+        doc = self.parser.doc
+        if query_name:
+            return [item for item in doc if item.get('name') == query_name]
+        if lineno:
+            return [doc[self.parser.find_path(lineno, level=1)[0]]]
+        return list(doc)
+
+    def materialized_refs(self, query_name=None, lineno=None):
+        """ Names of the queries with a `materialize` key referenced by the
+        queries to render, dependencies first """
+        if 'materialize' not in self.content:
+            return []
+        deps = []
+        for item in self._target_items(query_name, lineno):
+            self._resolve(_refs(item), [item.get('name')], deps)
+        return [name for name in deps
+                if self._named_item(name).get('materialize')]
+
+    def materialize_ttl(self, name):
+        """ Lifetime of the materialized results of a query, in seconds,
+        or None for the default """
+        ttl = self._named_item(name).get('materialize')
+        if ttl is True:
+            return None
+        return ttl
+
+    def render_list(self, overrides=None):
+        """ Render each top-level item separately.
+        Returns a list of (name, sql), skipping items without SQL. """
+        doc = self.parser.doc
+        if overrides:
+            sqls = [self.render_item(item, overrides) for item in doc]
+        else:
+            sqls = [self._render_index(i) for i in xrange(len(doc))]
+        return [(item.get('name'), sql)
+                for item, sql in zip(doc, sqls) if sql]
+
+    def render_query(self, name, overrides=None):
+        """ Render the query named `name` """
+        return self.render_item(self._named_item(name), overrides)
+
+    def _render_source(self, source, query_name=None):
+        """ Render the single item in `source`, cached by its own content.
+        Return '' if it is not named `query_name`, and None if it references
+        other queries and needs the whole document. """
+        render = get_render(source, self.processor_classes, self.format_mode,
+                            cache=ITEM_CACHE)
+        item = render.parser.doc[0]
+        if _refs(item):
+            return None
+        if query_name and item.get('name') != query_name:
+            return ''
+        return render._render_index(0)
+
+    def _render_index(self, index):
+        """ Render the top-level item at `index`, only once """
+        sql = self._rendered.get(index)
+        if sql is None:
+            sql = self.render_item(self.parser.doc[index])
+            self._rendered[index] = sql
+        return sql
+
+    def render_item(self, item, overrides=None):
+        """ Render `item` to SQL formatted with `format_mode`.
+
+        The queries referenced by name in its `with` key, and the queries
+        they reference, are inlined as CTEs in dependency order. Each
+        referenced query is only rendered once per document. Queries named
+        in `overrides` are replaced by the SQL it maps them to.
+        """
+        refs = _refs(item)
+        if not refs:
+            return sql_format(self._transform(item), self.format_mode)
+
+        overrides = overrides or {}
+        deps = []
+        self._resolve(refs, [item.get('name')], deps, overrides)
+        ctes = ',\n'.join(
+            '{} as (\n{}\n)'.format(
+                name, overrides.get(name) or self._named_body(name))
+            for name in deps)
+        body = _body(self._transform(omit(item, ['with'])))
+        if WITH_CLAUSE.match(body):
+            body = '{},\n{}'.format(ctes, WITH_CLAUSE.sub('', body, 1))
+        else:
+            body = '{}\n{}'.format(ctes, body)
+        return sql_format('with ' + body, self.format_mode)
+
+    def _named_item(self, name):
+        if self._names is None:
+            names = {}
+            for item in self.parser.doc:
+                if isinstance(item, dict) and 'name' in item:
+                    names.setdefault(item['name'], item)
+            self._names = names
+        if name not in self._names:
+            raise Exception("Cannot find the query named {}".format(name))
+        return self._names[name]
+
+    def _resolve(self, refs, path, deps, overrides=()):
+        """ Append the queries `refs` depend on, then `refs`, to `deps`.
+        `path` is the chain of references leading here. Dependencies of
+        overridden queries are skipped. """
+        for name in refs:
+            if name in deps:
+                continue
+            if name in path:
+                raise Exception("Cyclic reference between queries: {}".format(
+                    ' -> '.join(path[path.index(name):] + [name])))
+            if name not in overrides:
+                self._resolve(_refs(self._named_item(name)), path + [name],
+                              deps, overrides)
+            deps.append(name)
+
+    def _named_body(self, name):
+        """ SQL of the query named `name`, without its CTEs """
+        body = self._bodies.get(name)
+        if body is None:
+            item = omit(self._named_item(name), ['with'])
+            body = self._bodies[name] = _body(self._transform(item))
+        return body
+
+    def _transform(self, item):
+        """ Apply processors to `item` until it becomes a SQL string.
+
+        Processors are tried in a round-robin order, starting after the
+        last one applied, as if every processor was run on each pass. Only
+        the processors triggered by the keys of the item are considered.
+        """
+        seen = set()
+        last = -1
         for i in xrange(self.MAX_ITERATION):
-            for p in self.processors:
-                if isinstance(item, basestring):
-                    return item
-                if isinstance(item, CommentedMap):
-                    item = dict(item)
-                item = p.process(item)
+            if isinstance(item, basestring):
+                return item
+            if isinstance(item, CommentedMap):
+                item = dict(item)
+            index = self._next_processor(item, last)
+            if index is None:
+                raise Exception(
+                    "No processor can render the item:\n{}".format(item))
+            state = (index, repr(item))
+            if state in seen:
+                raise Exception(
+                    "Processors are looping on the item:\n{}".format(item))
+            seen.add(state)
+            item = self.processors[index].process(item)
+            last = index
 
         raise Exception(
-            "Cannot parse the item within {} iterations:\n{}".format(
+            "Cannot parse the item within {} transformations:\n{}".format(
                 self.MAX_ITERATION, item))
+
+    def _next_processor(self, item, last):
+        """ Return the index of the first processor after `last`, wrapping
+        around, which applies to `item` """
+        if isinstance(item, dict):
+            candidates = list(self._generic)
+            for key in item:
+                candidates.extend(self._dispatch.get(key, ()))
+            candidates.sort()
+        else:
+            candidates = range(len(self.processors))
+        ordered = [i for i in candidates if i > last] + \
+            [i for i in candidates if i <= last]
+        for index in ordered:
+            if self.processors[index].can_apply(item):
+                return index
+        return None
+
+
+def content_hash(content):
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return md5(content).hexdigest()
+
+
+def get_render(content, processors=None, format_mode='pretty',
+               cache=RENDER_CACHE):
+    """ Return a SQLRender of `content`. Renders are cached by content
+    hash, processors and format mode, so the document is only parsed, and
+    each query only rendered, once while the content does not change. """
+    processors = tuple(processors or SQLRender.DEFAULT_PROCESSORS)
+    key = (content_hash(content), processors, format_mode)
+    render = cache.get(key)
+    if render is None:
+        render = SQLRender(content, processors, format_mode)
+        cache.set(key, render, size=len(content))
+    return render
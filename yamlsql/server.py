@@ -1,15 +1,30 @@
 #!/usr/bin/env python
 
 from flask import Flask
+from funcy import decorator
 
 from yamlsql.dbmeta import DBMeta
-from yamlsql.render import SQLRender
+from yamlsql.render import ITEM_CACHE, RENDER_CACHE, get_render
 from yamlsql import emacs
-from yamlsql.base import api_request, emacs_converter
+from yamlsql.base import api_request, emacs_converter, as_bool
+from yamlsql.jobs import JOBS, DONE
+from yamlsql import buffers
+from yamlsql.connection import (connections as list_connections,
+                                connecting, using)
 
 app = Flask(__name__)
 
 
+@decorator
+def using_conn(call):
+    """ Keep the connection of the request from being evicted while the
+    request is handled """
+    if call.conn_id is None:
+        return call()
+    with using(call.conn_id):
+        return call()
+
+
 @app.route('/', methods=['GET'])
 @api_request
 def index():
@@ -18,23 +33,50 @@ def index():
 
 @app.route('/connect', methods=['POST'])
 @api_request
-def connect(conn_string, search_path=None):
+def connect(conn_string, search_path=None, **options):
+    """ Connect to a database. `options` are passed to DBMeta, e.g.
+    `stats_cache_ttl`, `stats_cache_size` or the pool settings `pool_size`,
+    `max_overflow`, `pool_recycle` and `pool_pre_ping`. """
     if not search_path:
         search_path = ['public']
-    db = DBMeta.create_instance(conn_string, search_path)
-    db.fetch_metadata()
+    if 'pool_pre_ping' in options:
+        options['pool_pre_ping'] = as_bool(options['pool_pre_ping'])
+    with connecting(conn_string, search_path, **options) as db:
+        db.fetch_metadata()
     return {"conn_id": db.conn_id}
 
+@app.route('/connections', methods=['GET'])
+@api_request
+def connections():
+    """ Pool usage of every open connection """
+    return list_connections()
+
 @app.route('/list_tables',  methods=['GET'])
 @api_request
-def list_tables(conn_id):
+@using_conn
+def list_tables(conn_id, schema=None):
     db = DBMeta.get_instance(conn_id)
-    return {'tables': db.list_tables()}
+    return {'tables': db.list_tables(schema)}
+
+@app.route('/complete', methods=['GET'])
+@api_request
+@using_conn
+def complete(conn_id, prefix='', context='table', table=None, limit=50):
+    db = DBMeta.get_instance(conn_id)
+    return {'matches': db.complete(prefix, context, table, limit)}
+
+@app.route('/refresh_metadata', methods=['POST'])
+@api_request
+@using_conn
+def refresh_metadata(conn_id, schemas=None, tables=None):
+    db = DBMeta.get_instance(conn_id)
+    return db.refresh_metadata(schemas=schemas, tables=tables)
 
 
 @app.route('/describe_table',  methods=['GET'])
 @api_request
 @emacs_converter(emacs.describe_table)
+@using_conn
 def describe_table(conn_id, name):
     db = DBMeta.get_instance(conn_id)
     fields = db.describe_table(name)
@@ -48,25 +90,184 @@ def describe_table(conn_id, name):
 @app.route('/describe_field',  methods=['GET'])
 @api_request
 @emacs_converter(emacs.describe_field)
-def describe_field(conn_id, table, field):
+@using_conn
+def describe_field(conn_id, table, field, sample=None, sample_method='system',
+                   mode='scan'):
     db = DBMeta.get_instance(conn_id)
-    result = db.describe_field(table, field)
+    result = db.describe_field(table, field, sample=sample,
+                               sample_method=sample_method, mode=mode)
     result['field_name'] = '{}.{}'.format(table, field)
     if not result:
         raise Exception('Cannot find field {}.{}'.format(table, field))
     return result
 
+@app.route('/invalidate', methods=['POST'])
+@api_request
+@using_conn
+def invalidate(conn_id, table=None, field=None, query=None, results=False):
+    """ Drop cached stats, the materialized results of `query`, or with
+    `results=1` all cached query results """
+    db = DBMeta.get_instance(conn_id)
+    if query:
+        return {'invalidated': db.drop_materialized(query)}
+    if as_bool(results):
+        return {'invalidated': db.invalidate_results()}
+    return {'invalidated': db.invalidate(table, field)}
+
+@app.route('/cache_stats', methods=['GET'])
+@api_request
+@using_conn
+def cache_stats(conn_id=None):
+    result = {
+        'render': RENDER_CACHE.stats(),
+        'render_items': ITEM_CACHE.stats()
+        }
+    if conn_id:
+        result.update(DBMeta.get_instance(conn_id).cache_stats())
+    return result
+
 @app.route('/render_sql',  methods=['POST'])
 @api_request
-def render_sql(content, lineno=None):
+def render_sql(content=None, lineno=None, buffer_id=None,
+               format_mode='pretty'):
+    render = get_render(_content(content, buffer_id), format_mode=format_mode)
     return {
-        'sql': SQLRender(content).render(lineno=lineno)
+        'sql': render.render(lineno=lineno)
         }
 
+def _content(content, buffer_id):
+    """ Content sent with the request, or kept in buffer `buffer_id` """
+    if buffer_id:
+        return buffers.get_buffer(buffer_id).content
+    if content is None:
+        raise Exception('Either content or buffer_id is required')
+    return content
+
+@app.route('/open_buffer', methods=['POST'])
+@api_request
+def open_buffer(content):
+    return buffers.open_buffer(content).to_dict()
+
+@app.route('/update_buffer', methods=['POST'])
+@api_request
+def update_buffer(buffer_id, edits, version=None):
+    return buffers.update_buffer(buffer_id, edits, version).to_dict()
+
+@app.route('/close_buffer', methods=['POST'])
+@api_request
+def close_buffer(buffer_id):
+    return {'closed': buffers.close_buffer(buffer_id)}
+
 @app.route('/run_sql', methods=['POST'])
 @api_request
+@using_conn
+def run_sql(conn_id, content=None, lineno=None, limit=100, stream=False,
+            buffer_id=None, push_limit=True, count=False, cache=False,
+            timeout=None, confirm=False, **options):
+    """ Run the rendered query. With `async=1` the query is queued as a
+    job and its id is returned right away. With `multi=1` and no `lineno`,
+    every query runs concurrently and gets its own result.
+
+    Unless `push_limit` is off, the limit is pushed into plain SELECTs, and
+    `count` returns their total number of rows with a separate query.
+    With `cache` on, SELECTs run recently may return their cached results.
+
+    `timeout` is the statement timeout in milliseconds. Queries estimated
+    to exceed the cost thresholds of the connection are rejected unless
+    `confirm` is on. """
+    db = DBMeta.get_instance(conn_id)
+    # nobody reads the SQL which is executed, skip formatting it
+    render = get_render(_content(content, buffer_id), format_mode='none')
+    timeout = timeout and int(timeout)
+    stream = as_bool(stream)
+    confirm = as_bool(confirm)
+    run_options = {
+        'push_limit': as_bool(push_limit),
+        'count': as_bool(count),
+        'cache': as_bool(cache),
+        'timeout': timeout,
+        'confirm': confirm
+        }
+
+    def prepare():
+        overrides = _materialize(db, render, lineno, timeout, confirm)
+        return render.render(lineno=lineno, overrides=overrides), \
+            bool(overrides)
+
+    if as_bool(options.get('multi')) and not lineno:
+        overrides = _materialize(db, render, lineno, timeout, confirm)
+        return {'results': db.run_many(
+            render.render_list(overrides), limit, session=bool(overrides),
+            **run_options)}
+    if as_bool(options.get('async')):
+        # materializing may take as long as the query, leave it to the job
+        return JOBS.submit(db, prepare, limit=limit, **run_options).to_dict()
+    sql, session = prepare()
+    return _run_sql(db, sql, limit, stream, session, run_options)
+
+def _materialize(db, render, lineno, timeout=None, confirm=False):
+    """ Materialize the queries marked with `materialize` which the queries
+    to run reference. Returns the SQL reading the results of each of them,
+    by name, to render the queries with. """
+    overrides = {}
+    for name in render.materialized_refs(lineno=lineno):
+        table_name = db.materialize(
+            name, render.render_query(name, overrides),
+            ttl=render.materialize_ttl(name), timeout=timeout,
+            confirm=confirm)
+        overrides[name] = 'select * from {}'.format(table_name)
+    return overrides
+
+@emacs_converter(emacs.run_sql)
+def _run_sql(db, sql, limit, stream, session, run_options):
+    return db.run_sql(sql, limit=limit, stream=stream, session=session,
+                      **run_options)
+
+@app.route('/explain', methods=['POST'])
+@api_request
+@using_conn
+def explain(conn_id, lineno, content=None, buffer_id=None):
+    """ Estimated plan of the query at `lineno`, which is not run """
+    db = DBMeta.get_instance(conn_id)
+    render = get_render(_content(content, buffer_id), format_mode='none')
+    plan = db.explain(render.render(lineno=lineno))
+    return {
+        'plan': plan,
+        'cost': plan['Total Cost'],
+        'rows': plan['Plan Rows']
+        }
+
+@app.route('/fetch_more', methods=['POST'])
+@api_request
 @emacs_converter(emacs.run_sql)
-def run_sql(conn_id, content, lineno=None, limit=100):
+@using_conn
+def fetch_more(conn_id, handle, limit=100):
+    db = DBMeta.get_instance(conn_id)
+    return db.fetch_more(handle, limit=limit)
+
+@app.route('/close_cursor', methods=['POST'])
+@api_request
+@using_conn
+def close_cursor(conn_id, handle):
     db = DBMeta.get_instance(conn_id)
-    sql = SQLRender(content).render(lineno=lineno)
-    return db.run_sql(sql, limit=limit)
+    return {'closed': db.close_cursor(handle)}
+
+@app.route('/job_status', methods=['GET'])
+@api_request
+def job_status(job_id):
+    return JOBS.get(job_id).to_dict()
+
+@app.route('/job_result', methods=['GET'])
+@api_request
+@emacs_converter(emacs.run_sql)
+def job_result(job_id):
+    job = JOBS.get(job_id)
+    if job.status != DONE:
+        raise Exception('Job {} is {}{}'.format(
+            job_id, job.status, ': ' + job.error if job.error else ''))
+    return job.result
+
+@app.route('/cancel_job', methods=['POST'])
+@api_request
+def cancel_job(job_id):
+    return {'cancelled': JOBS.cancel(job_id)}
@@ -0,0 +1,42 @@
+""" On-disk snapshots of database metadata, so that a restarted server does
+not have to reload the whole catalog before answering requests. """
+import json
+import os
+import zlib
+from tempfile import NamedTemporaryFile
+
+SNAPSHOT_DIR = os.environ.get(
+    'YAMLSQL_SNAPSHOT_DIR', os.path.expanduser('~/.yamlsql/snapshots'))
+SNAPSHOT_VERSION = 1
+
+
+def snapshot_path(snapshot_dir, conn_id):
+    return os.path.join(snapshot_dir, '{}.meta'.format(conn_id))
+
+
+def load_snapshot(snapshot_dir, conn_id):
+    """ Return the snapshot saved for `conn_id`, or None if there is no
+    usable snapshot """
+    try:
+        with open(snapshot_path(snapshot_dir, conn_id), 'rb') as f:
+            snapshot = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+    except (IOError, OSError, ValueError, zlib.error):
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+    return snapshot
+
+
+def save_snapshot(snapshot_dir, conn_id, markers, meta):
+    """ Save `meta` along with the catalog `markers` it was loaded at.
+    The file is replaced atomically so readers never see a partial one. """
+    if not os.path.isdir(snapshot_dir):
+        os.makedirs(snapshot_dir)
+    data = json.dumps({
+        'version': SNAPSHOT_VERSION,
+        'markers': markers,
+        'meta': meta
+        }, separators=(',', ':'))
+    with NamedTemporaryFile(dir=snapshot_dir, delete=False) as f:
+        f.write(zlib.compress(data.encode('utf-8')))
+    os.rename(f.name, snapshot_path(snapshot_dir, conn_id))